@@ -0,0 +1,154 @@
+import time
+import asyncio
+import threading
+from config import Config
+
+class TokenBucket:
+    """Token bucket that lets callers go into debt and wait it off"""
+
+    def __init__(self, rate, burst_seconds=1.0):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = rate * burst_seconds
+        self.last_refill = time.monotonic()
+
+    def set_rate(self, rate):
+        """Change the refill rate (0 = unlimited)"""
+        self.refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * self.burst_seconds)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.rate * self.burst_seconds, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self, nbytes):
+        """Take nbytes and return how long the caller must wait before using them"""
+        if self.rate <= 0:
+            return 0
+        self.refill()
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class BandwidthScheduler:
+    """Global download/upload caps with weighted per-user fair share.
+    
+    Every engine draws from the same buckets: HTTP chunk reads await consume(),
+    yt-dlp workers sleep off the delay reserve() returns for each progress report they
+    send, and libtorrent gets share() applied as a per-torrent limit while charge() records what it used.
+    Thread-safe, and rates can be changed at runtime with set_rate().
+    """
+    
+    DIRECTIONS = ('download', 'upload')
+
+    def __init__(self, download_rate=0, upload_rate=0):
+        self.lock = threading.Lock()
+        self.rates = {'download': download_rate, 'upload': upload_rate}
+        self.buckets = {direction: TokenBucket(rate) for direction, rate in self.rates.items()}
+        self.users = {}  # user_id -> {'weight', 'jobs', 'buckets'}
+        self.weights = {}  # user_id -> weight, remembered while the user is idle
+
+    def join(self, user_id):
+        """Register an active job for user_id so it gets a fair share"""
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None:
+                user = {
+                    'weight': self.weights.get(user_id, 1),
+                    'jobs': 0,
+                    'buckets': {direction: TokenBucket(0) for direction in self.DIRECTIONS}
+                }
+                self.users[user_id] = user
+            user['jobs'] += 1
+            self._rebalance()
+
+    def leave(self, user_id):
+        """Unregister one job of user_id, releasing its share to everyone else"""
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return
+            user['jobs'] -= 1
+            if user['jobs'] <= 0:
+                del self.users[user_id]
+            self._rebalance()
+
+    def set_rate(self, direction, rate):
+        """Change the global cap for a direction in bytes/s (0 = unlimited)"""
+        with self.lock:
+            self.rates[direction] = max(0, int(rate))
+            self.buckets[direction].set_rate(self.rates[direction])
+            self._rebalance()
+
+    def set_weight(self, user_id, weight):
+        """Give user_id a bigger (or smaller) slice of the shared bandwidth"""
+        with self.lock:
+            self.weights[user_id] = max(0.1, float(weight))
+            if user_id in self.users:
+                self.users[user_id]['weight'] = self.weights[user_id]
+            self._rebalance()
+
+    def share(self, user_id, direction='download'):
+        """Current fair-share rate of user_id in bytes/s (0 = unlimited)"""
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return self.rates[direction]
+            return user['buckets'][direction].rate
+
+    def reserve(self, user_id, nbytes, direction='download'):
+        """Take nbytes from the global and user buckets, return the delay owed"""
+        with self.lock:
+            delay = self.buckets[direction].reserve(nbytes)
+            user = self.users.get(user_id)
+            if user is not None:
+                delay = max(delay, user['buckets'][direction].reserve(nbytes))
+            return delay
+
+    async def consume(self, user_id, nbytes, direction='download'):
+        """Wait until nbytes may be transferred - for event loop callers"""
+        delay = self.reserve(user_id, nbytes, direction)
+        if delay > 0.001:
+            await asyncio.sleep(delay)
+
+    def charge(self, user_id, nbytes, direction='download'):
+        """Record bytes moved by an engine that enforces its own limit (libtorrent)"""
+        self.reserve(user_id, nbytes, direction)
+
+    def throttled_progress(self, user_id, callback, direction='upload'):
+        """Wrap a pyrogram-style progress callback so each reported part is paced"""
+        state = {'last': 0}
+
+        async def progress(current, total, *args, **kwargs):
+            delta = current - state['last']
+            state['last'] = current
+            if delta > 0:
+                await self.consume(user_id, delta, direction)
+            if callback:
+                await callback(current, total, *args, **kwargs)
+                
+        return progress
+
+    def stats(self):
+        """Global caps and per-user shares for status displays"""
+        with self.lock:
+            return {
+                'rates': dict(self.rates),
+                'users': {
+                    user_id: {direction: user['buckets'][direction].rate for direction in self.DIRECTIONS}
+                    for user_id, user in self.users.items()
+                }
+            }
+
+    def _rebalance(self):
+        """Split each global cap between active users by weight - caller holds the lock"""
+        total_weight = sum(user['weight'] for user in self.users.values())
+        for user in self.users.values():
+            for direction in self.DIRECTIONS:
+                rate = self.rates[direction]
+                share = int(rate * user['weight'] / total_weight) if rate and total_weight else 0
+                user['buckets'][direction].set_rate(share)
+
+bandwidth = BandwidthScheduler(Config.SPEED_LIMIT, Config.UPLOAD_SPEED_LIMIT)
@@ -8,9 +8,17 @@ from pyrogram.enums import ParseMode
 from config import Config
 from database import db
 from downloader import downloader
+from bandwidth import bandwidth
+from diskspace import disk_space
+from router import router
+from ytdlp_pool import ytdlp_pool
+from torrents import torrent_session
+from uploader import StreamingUpload, FolderUpload, send_file, media_sessions
 from helpers import (
     Progress, humanbytes, is_url, is_magnet, 
-    is_video_file, get_file_extension, sanitize_filename
+    get_file_extension, sanitize_filename,
+    parse_download_request, CancelToken, PlaylistProgress, parse_file_selection, get_path_size,
+    truncate_text
 )
 import time
 import random
@@ -179,6 +187,9 @@ async def restart_command(client, message: Message):
                     pass
         user_tasks.clear()
         
+        # Save torrent resume data and free the listen port for the new process
+        await downloader.close()
+        
         # Restart using subprocess (non-blocking)
         import subprocess
         subprocess.Popen([sys.executable] + sys.argv)
@@ -270,16 +281,19 @@ async def settings_callback(client, callback: CallbackQuery):
 • Custom filename: {}
 • Custom caption: {}
 • Thumbnail: {}
+• Streaming upload: {}
 
 **How to set:**
 📝 Send `/setname <filename>` - Set custom filename
 💬 Send `/setcaption <text>` - Set custom caption
 🖼️ Send a photo - Set as thumbnail
+⚡ Send `/stream` - Upload while downloading
 🗑️ Send `/clearsettings` - Clear all settings
 👁️ Send `/showthumb` - View your thumbnail""".format(
         settings.get('filename', 'Not set'),
         'Set ✅' if settings.get('caption') else 'Not set',
-        'Set ✅' if settings.get('thumbnail') else 'Not set'
+        'Set ✅' if settings.get('thumbnail') else 'Not set',
+        'On ✅' if settings.get('stream') else 'Off'
     )
     
     keyboard = InlineKeyboardMarkup([
@@ -301,16 +315,19 @@ async def settings_command(client, message: Message):
 • Custom filename: {}
 • Custom caption: {}
 • Thumbnail: {}
+• Streaming upload: {}
 
 **How to set:**
 📝 Send `/setname <filename>` - Set custom filename
 💬 Send `/setcaption <text>` - Set custom caption
 🖼️ Send a photo - Set as thumbnail
+⚡ Send `/stream` - Upload while downloading
 🗑️ Send `/clearsettings` - Clear all settings
 👁️ Send `/showthumb` - View your thumbnail""".format(
         settings.get('filename', 'Not set'),
         'Set ✅' if settings.get('caption') else 'Not set',
-        'Set ✅' if settings.get('thumbnail') else 'Not set'
+        'Set ✅' if settings.get('thumbnail') else 'Not set',
+        'On ✅' if settings.get('stream') else 'Off'
     )
     
     keyboard = InlineKeyboardMarkup([
@@ -408,6 +425,152 @@ async def back_start(client, callback: CallbackQuery):
             print(f"Error in back_start: {e}")
             await callback.answer("Error going back. Use /start", show_alert=True)
 
+def get_media_file_id(sent_message):
+    """Get (file_id, media_type) of the media in a sent message"""
+    for media_type in ('video', 'document', 'photo', 'audio'):
+        media = getattr(sent_message, media_type, None)
+        if media:
+            return media.file_id, media_type
+    return None, None
+
+def cancellable_progress(client, token, callback):
+    """Stop a pyrogram upload at its next part once token is cancelled"""
+    async def progress(current, total, *args, **kwargs):
+        if token.cancelled:
+            client.stop_transmission()
+        await callback(current, total, *args, **kwargs)
+    return progress
+
+def drop_task(user_id, token):
+    """Forget the user's task - unless a newer one has replaced it meanwhile"""
+    task = user_tasks.get(user_id)
+    if task and task.get('token') is token:
+        del user_tasks[user_id]
+
+async def upload_file(client, chat_id, filepath, upload_type, caption, thumbnail, progress):
+    """Upload one file as document or in its original format, return the sent message"""
+    # Auto-detect and upload in original format
+    ext = get_file_extension(filepath).lower()
+    image_exts = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']
+    
+    if upload_type != 'doc' and ext in image_exts:
+        return await client.send_photo(
+            chat_id=chat_id,
+            photo=filepath,
+            caption=caption,
+            progress=progress,
+            progress_args=("Uploading",)
+        )
+    
+    # Videos and documents - parts go out in parallel over several media sessions
+    return await send_file(client, chat_id, filepath, upload_type, caption, thumbnail, progress)
+
+async def send_from_cache(client, chat_id, cached, caption):
+    """Resend a cached Telegram file by file_id - returns None if the id is no longer valid"""
+    try:
+        return await client.send_cached_media(
+            chat_id=chat_id,
+            file_id=cached['file_id'],
+            caption=caption
+        )
+    except Exception as e:
+        print(f"Cached file_id rejected, invalidating: {e}")
+        await db.invalidate_cached_file(cached['file_id'])
+        return None
+
+async def complete_upload(client, progress_message, from_user, filepath, filesize, upload_type):
+    """Record a finished upload, start the cooldown and log it"""
+    user_id = from_user.id
+    filename = os.path.basename(filepath)
+    
+    await db.update_stats(user_id, upload=True)
+    await db.log_action(user_id, "upload", filepath)
+    
+    # Delete progress message
+    try:
+        await progress_message.delete()
+    except:
+        pass
+    
+    # Set cooldown after successful upload
+    user_cooldowns[user_id] = time.time()
+    
+    # Success message with cooldown
+    remaining = get_remaining_time(user_id)
+    time_str = format_time(remaining)
+    
+    success_msg = await client.send_message(
+        progress_message.chat.id,
+        f"✅ **Upload Complete!**\n\n"
+        f"⏳ You can send new task after **{time_str}**"
+    )
+    
+    # Start cooldown refresh task
+    asyncio.create_task(cooldown_refresh_message(client, success_msg, user_id))
+    
+    # Log to channel
+    try:
+        upload_type_name = 'Original' if upload_type == 'original' else 'Document'
+        
+        await client.send_message(
+            Config.LOG_CHANNEL,
+            f"📤 **New Upload**\n\n"
+            f"👤 User: {from_user.mention}\n"
+            f"📁 File: `{filename}`\n"
+            f"💾 Size: {humanbytes(filesize)}\n"
+            f"📊 Type: {upload_type_name}"
+        )
+    except:
+        pass
+
+async def upload_folder(client, progress_message, from_user, dirpath, upload_type, token):
+    """Upload every file of a finished multi-file download, then wrap up like a single upload"""
+    user_id = from_user.id
+    settings = user_settings.get(user_id, {})
+    
+    def caption(path):
+        return settings.get('caption',
+            f"📁 **{os.path.basename(path)}**\n\n"
+            f"💾 **Size:** {humanbytes(os.path.getsize(path))}\n"
+            f"⚡ **Powered by:** {Config.DEVELOPER}"
+        )
+        
+    progress = Progress(client, progress_message)
+    folder = FolderUpload(
+        client, progress_message.chat.id, dirpath,
+        upload_type=upload_type,
+        thumbnail=settings.get('thumbnail'),
+        caption=caption,
+        progress_callback=bandwidth.throttled_progress(user_id, progress.progress_callback),
+        concurrency=Config.FOLDER_UPLOAD_CONCURRENCY
+    )
+    if not folder.files:
+        raise ValueError("The download has no files to upload")
+        
+    remove_callback = token.add_callback(folder.abort)
+    try:
+        sent, failed = await folder.run()
+    except asyncio.CancelledError:
+        # /cancel aborted the uploads
+        if not token.cancelled:
+            raise
+        await progress_message.edit_text(f"🛑 **Upload Cancelled!**\n\n📤 Sent {folder.sent} of {len(folder.files)} files.")
+        return
+    finally:
+        remove_callback()
+        
+    if not sent:
+        raise ValueError(failed[0][1] if failed else "Nothing was sent")
+        
+    await complete_upload(client, progress_message, from_user, dirpath, folder.total_size, upload_type)
+    if failed:
+        names = "\n".join(f"• `{os.path.basename(path)}`" for path, _ in failed[:10])
+        await client.send_message(
+            progress_message.chat.id,
+            f"⚠️ **{len(failed)} of {len(folder.files)} files failed to upload:**\n\n{names}"
+        )
+        print(f"Folder upload errors for user {user_id}: {failed}")
+
 # Handle file upload type selection
 @app.on_callback_query(filters.regex("^upload_"))
 async def handle_upload_type(client, callback: CallbackQuery):
@@ -419,12 +582,24 @@ async def handle_upload_type(client, callback: CallbackQuery):
         return
     
     task = user_tasks[user_id]
+    if task.get('busy') or not task.get('filepath'):
+        await callback.answer("⏳ Already in progress!", show_alert=True)
+        return
+    
     filepath = task['filepath']
     upload_type = data.split('_')[1]  # doc or original
+    token = task.setdefault('token', CancelToken())
+    task['busy'] = True
     
     await callback.message.edit_text("⬆️ **Uploading to Telegram...**\n\nPlease wait...")
     
+    bandwidth.join(user_id)
     try:
+        # Multi-file torrents arrive as a directory - its files go out one by one
+        if os.path.isdir(filepath):
+            await upload_folder(client, callback.message, callback.from_user, filepath, upload_type, token)
+            return
+        
         # Get user settings
         settings = user_settings.get(user_id, {})
         thumbnail = settings.get('thumbnail')
@@ -438,115 +613,34 @@ async def handle_upload_type(client, callback: CallbackQuery):
             f"⚡ **Powered by:** {Config.DEVELOPER}"
         )
         
-        # Progress tracker
-        progress = Progress(client, callback.message)
-        
-        if upload_type == 'doc':
-            # Upload as document
-            await client.send_document(
-                chat_id=callback.message.chat.id,
-                document=filepath,
-                caption=caption,
-                thumb=thumbnail,
-                progress=progress.progress_callback,
-                progress_args=("Uploading",)
-            )
-        else:  # original
-            # Auto-detect and upload in original format
-            ext = get_file_extension(filepath).lower()
-            image_exts = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']
-            
-            if ext in image_exts:
-                await client.send_photo(
-                    chat_id=callback.message.chat.id,
-                    photo=filepath,
-                    caption=caption,
-                    progress=progress.progress_callback,
-                    progress_args=("Uploading",)
-                )
-            elif is_video_file(filepath):
-                # Get video metadata
-                duration = width = height = 0
-                try:
-                    import subprocess
-                    result = subprocess.run(
-                        ['ffprobe', '-v', 'error', '-show_entries',
-                         'format=duration:stream=width,height', '-of',
-                         'default=noprint_wrappers=1', filepath],
-                        capture_output=True, text=True, timeout=10
-                    )
-                    for line in result.stdout.split('\n'):
-                        if 'duration=' in line:
-                            duration = int(float(line.split('=')[1]))
-                        elif 'width=' in line:
-                            width = int(line.split('=')[1])
-                        elif 'height=' in line:
-                            height = int(line.split('=')[1])
-                except:
-                    pass
-                
-                await client.send_video(
-                    chat_id=callback.message.chat.id,
-                    video=filepath,
-                    caption=caption,
-                    thumb=thumbnail,
-                    duration=duration,
-                    width=width,
-                    height=height,
-                    supports_streaming=True,
-                    progress=progress.progress_callback,
-                    progress_args=("Uploading",)
-                )
-            else:
-                # Fallback to document
-                await client.send_document(
-                    chat_id=callback.message.chat.id,
-                    document=filepath,
-                    caption=caption,
-                    thumb=thumbnail,
-                    progress=progress.progress_callback,
-                    progress_args=("Uploading",)
-                )
-        
-        await db.update_stats(user_id, upload=True)
-        await db.log_action(user_id, "upload", filepath)
-        
-        # Delete progress message
-        try:
-            await callback.message.delete()
-        except:
-            pass
-        
-        # Set cooldown after successful upload
-        user_cooldowns[user_id] = time.time()
-        
-        # Success message with cooldown
-        remaining = get_remaining_time(user_id)
-        time_str = format_time(remaining)
-        
-        success_msg = await client.send_message(
-            callback.message.chat.id,
-            f"✅ **Upload Complete!**\n\n"
-            f"⏳ You can send new task after **{time_str}**"
-        )
-        
-        # Start cooldown refresh task
-        asyncio.create_task(cooldown_refresh_message(client, success_msg, user_id))
+        # Same source, name and upload type sent before - resend by file_id.
+        # Custom thumbnails can't be applied to a cached file, so those always upload.
+        cache_keys = task.get('cache_keys', [])
+        sent = None
+        if cache_keys and not thumbnail:
+            cached = await db.get_cached_file(cache_keys, upload_type, filename)
+            if cached:
+                sent = await send_from_cache(client, callback.message.chat.id, cached, caption)
         
-        # Log to channel
-        try:
-            upload_type_name = 'Original' if upload_type == 'original' else 'Document'
+        if sent is None:
+            # Progress tracker - paced by the user's share of the upload budget
+            progress = Progress(client, callback.message)
+            upload_progress = bandwidth.throttled_progress(user_id, progress.progress_callback)
             
-            await client.send_message(
-                Config.LOG_CHANNEL,
-                f"📤 **New Upload**\n\n"
-                f"👤 User: {callback.from_user.mention}\n"
-                f"📁 File: `{filename}`\n"
-                f"💾 Size: {humanbytes(filesize)}\n"
-                f"📊 Type: {upload_type_name}"
+            sent = await upload_file(
+                client, callback.message.chat.id, filepath,
+                upload_type, caption, thumbnail, cancellable_progress(client, token, upload_progress)
             )
-        except:
-            pass
+            
+            if token.cancelled:
+                await callback.message.edit_text("🛑 **Upload Cancelled!**")
+                return
+            
+            if cache_keys and not thumbnail:
+                file_id, media_type = get_media_file_id(sent)
+                await db.cache_file(cache_keys, file_id, media_type, upload_type, filename, filesize)
+        
+        await complete_upload(client, callback.message, callback.from_user, filepath, filesize, upload_type)
         
     except Exception as e:
         error_msg = str(e)
@@ -557,9 +651,9 @@ async def handle_upload_type(client, callback: CallbackQuery):
         print(f"Upload error for user {user_id}: {error_msg}")
     
     finally:
+        bandwidth.leave(user_id)
         downloader.cleanup(filepath)
-        if user_id in user_tasks:
-            del user_tasks[user_id]
+        drop_task(user_id, token)
 
 async def cooldown_refresh_message(client, message, user_id):
     """Refresh the cooldown message every 10 seconds"""
@@ -616,7 +710,7 @@ async def handle_rename_callback(client, callback: CallbackQuery):
     data = callback.data
     user_id = callback.from_user.id
     
-    if user_id not in user_tasks:
+    if user_id not in user_tasks or user_tasks[user_id].get('busy'):
         await callback.answer("⚠️ Task expired!", show_alert=True)
         return
     
@@ -649,14 +743,37 @@ async def handle_rename_callback(client, callback: CallbackQuery):
         )
         await callback.answer()
 
-# Handle text input (URL or rename)
-@app.on_message(filters.text & filters.private & ~filters.command(["start", "help", "about", "status", "settings", "setname", "setcaption", "clearsettings", "showthumb", "total", "broadcast", "cancel", "ping", "restart"]))
+# Handle torrent file choice buttons
+@app.on_callback_query(filters.regex("^files_"))
+async def handle_files_callback(client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    choice = user_tasks.get(user_id, {}).get('file_choice')
+    
+    if not choice or choice['future'].done():
+        await callback.answer("⚠️ Task expired!", show_alert=True)
+        return
+        
+    sequential = callback.data == "files_seq"
+    choice['future'].set_result((set(range(len(choice['files']))), sequential))
+    await callback.answer("▶️ Downloading in order" if sequential else "📥 Downloading all files")
+
+# Handle text input (URL, file choice or rename)
+@app.on_message(filters.text & filters.private & ~filters.command(["start", "help", "about", "status", "settings", "setname", "setcaption", "clearsettings", "showthumb", "total", "broadcast", "cancel", "ping", "restart", "setlimit", "stream"]))
 async def handle_text_input(client, message: Message):
     user_id = message.from_user.id
     
     # Try to add reaction
     await add_reaction(message)
     
+    # Check if waiting for a torrent file choice
+    choice = user_tasks.get(user_id, {}).get('file_choice')
+    if choice and not choice['future'].done():
+        try:
+            choice['future'].set_result(parse_file_selection(message.text, len(choice['files'])))
+        except ValueError as e:
+            await message.reply_text(f"❌ **Error:** {str(e)}\n\nSend numbers like `1,3,5-7` or `all`.")
+        return
+    
     # Check if waiting for rename
     if user_id in user_tasks and user_tasks[user_id].get('waiting_rename'):
         new_name = sanitize_filename(message.text.strip())
@@ -668,7 +785,8 @@ async def handle_text_input(client, message: Message):
         try:
             # Rename file
             if os.path.exists(filepath):
-                os.rename(filepath, new_path)
+                # Shared downloads are hardlinked so other users keep their copy
+                new_path = downloader.rename(filepath, new_path)
                 user_tasks[user_id]['filepath'] = new_path
                 user_tasks[user_id]['waiting_rename'] = False
                 
@@ -691,8 +809,12 @@ async def handle_text_input(client, message: Message):
             await message.reply_text(f"❌ **Rename failed:** {str(e)}")
         return
     
-    # Check if it's a URL or magnet
-    url = message.text.strip()
+    # Check if it's a URL or magnet, optionally followed by "| filename | sha256:<hex>"
+    try:
+        url, filename, checksum = parse_download_request(message.text)
+    except ValueError as e:
+        await message.reply_text(f"❌ **Error:** {str(e)}")
+        return
     if not (is_url(url) or is_magnet(url)):
         return
     
@@ -707,7 +829,7 @@ async def handle_text_input(client, message: Message):
         return
     
     # Process as download
-    await process_download(client, message, url)
+    await process_download(client, message, url, sanitize_filename(filename) if filename else None, checksum)
 
 # Handle torrent files and any documents
 @app.on_message(filters.document & filters.private)
@@ -846,7 +968,7 @@ async def handle_direct_file_upload(client, message: Message):
         await db.log_action(user_id, "error", str(e))
 
 # Download processing function
-async def process_download(client, message: Message, url):
+async def process_download(client, message: Message, url, filename=None, checksum=None):
     user_id = message.from_user.id
     
     await db.add_user(user_id, message.from_user.username, message.from_user.first_name)
@@ -858,14 +980,136 @@ async def process_download(client, message: Message, url):
     )
     
     try:
+        # Already sent this source before - resend by file_id without downloading anything
+        cache_keys = [downloader.job_key(url)]
+        if checksum and checksum.get('sha256'):
+            # Same content from any source counts
+            cache_keys.append(f"sha256:{checksum['sha256']}")
+        settings = user_settings.get(user_id, {})
+        if not settings.get('thumbnail'):
+            cached = await db.get_cached_file(cache_keys, file_name=filename)
+            if cached:
+                caption = settings.get('caption',
+                    f"📁 **{cached['file_name']}**\n\n"
+                    f"💾 **Size:** {humanbytes(cached['file_size'])}\n"
+                    f"⚡ **Powered by:** {Config.DEVELOPER}"
+                )
+                if await send_from_cache(client, message.chat.id, cached, caption):
+                    await status_msg.edit_text(
+                        "⚡ **Sent instantly from cache!**\n\n"
+                        f"📁 **File:** `{cached['file_name']}`"
+                    )
+                    await db.update_stats(user_id, upload=True)
+                    await db.log_action(user_id, "cache_hit", str(url))
+                    return
+        
+        # Registered before anything is transferred so /cancel can stop the download
+        token = CancelToken()
+        user_tasks[user_id] = {
+            'token': token,
+            'busy': True,
+            'filepath': None,
+            'url': url if isinstance(url, str) else 'torrent',
+            'cache_keys': cache_keys,
+            'waiting_rename': False
+        }
+        
+        # Preflight direct links and known torrents - show name/size and reject oversized files before transferring
+        info = await downloader.preflight(url)
+        if info:
+            # Multi-file torrents may still fit once the user picks fewer files
+            if info['size'] > Config.MAX_FILE_SIZE and info.get('files', 1) <= 1:
+                await status_msg.edit_text(
+                    f"❌ **Download Failed!**\n\n"
+                    f"**Error:** File size ({humanbytes(info['size'])}) exceeds 4GB limit"
+                )
+                drop_task(user_id, token)
+                return
+            
+            await status_msg.edit_text(
+                "🔄 **Processing your request...**\n\n"
+                f"📁 **File:** `{info['filename'] or os.path.basename(info['url'].split('?')[0]) or 'Unknown'}`\n"
+                + (f"🗂 **Files:** {info['files']}\n" if info.get('files', 1) > 1 else "")
+                + f"💾 **Size:** {humanbytes(info['size']) if info['size'] else 'Unknown'}\n\n"
+                "Starting download..."
+            )
+        
+        # Playlists and channels - every entry becomes its own download and upload
+        engine = router.route(url)
+        if engine == 'ytdlp' or (engine is None and info and info['content_type'] == 'text/html'):
+            playlist = await downloader.get_playlist(url)
+            if playlist:
+                await process_playlist(client, message, status_msg, url, playlist, token)
+                return
+        
+        # Streaming mode - upload parts as they land on disk instead of after the download
+        stream = None
+        upload_msg = None
+        if settings.get('stream'):
+            upload_msg = await message.reply_text(
+                "⬆️ **Streaming upload**\n\n"
+                "Starts as soon as the first parts are downloaded..."
+            )
+            upload_progress = Progress(client, upload_msg)
+            stream = StreamingUpload(
+                client, message.chat.id,
+                thumbnail=settings.get('thumbnail'),
+                progress_callback=bandwidth.throttled_progress(user_id, upload_progress.progress_callback)
+            )
+            token.add_callback(stream.abort)
+        
+        # Multi-file torrents - the user picks the files; in sequential mode each one
+        # is uploaded as soon as it is complete, in order, while the rest downloads
+        early = {'sequential': False, 'upload': None, 'msg': None, 'sent': 0, 'failed': 0}
+        
+        async def select_files(files):
+            chosen, early['sequential'] = await ask_file_selection(status_msg, user_id, files)
+            return chosen, early['sequential']
+            
+        async def file_done(path):
+            if not early['sequential']:
+                return
+            previous = early['upload']
+            
+            async def upload_next():
+                if previous:
+                    await previous
+                await upload_torrent_file(client, message, path, token, early)
+                
+            early['upload'] = asyncio.create_task(upload_next())
+        
         # Download with progress
         progress = Progress(client, status_msg)
         filepath, error = await downloader.download(
             url, 
-            progress_callback=progress.progress_callback
+            filename=filename,
+            progress_callback=progress.progress_callback,
+            user_id=user_id,
+            stream=stream,
+            checksum=checksum,
+            cancel_token=token,
+            select_files=select_files,
+            file_done=file_done
         )
         
+        if token.cancelled and not error:
+            # Cancelled right as it finished - give the file back
+            downloader.cleanup(filepath)
+            error = "Download cancelled"
+        
         if error:
+            drop_task(user_id, token)
+            if stream:
+                stream.abort()
+                try:
+                    await upload_msg.delete()
+                except:
+                    pass
+            if early['upload']:
+                early['upload'].cancel()
+            if token.cancelled:
+                await status_msg.edit_text("🛑 **Download Cancelled!**")
+                return
             await status_msg.edit_text(
                 f"❌ **Download Failed!**\n\n"
                 f"**Error:** {error}\n\n"
@@ -876,31 +1120,34 @@ async def process_download(client, message: Message, url):
         await db.update_stats(user_id, download=True)
         await db.log_action(user_id, "download", str(url) if isinstance(url, str) else "torrent")
         
-        # Store task
-        user_tasks[user_id] = {
-            'filepath': filepath,
-            'url': url if isinstance(url, str) else 'torrent',
-            'waiting_rename': False
-        }
+        # Content hash from the download itself - lets identical files from other sources hit the cache
+        hashes = downloader.file_hashes.get(filepath)
+        if hashes and f"sha256:{hashes['sha256']}" not in cache_keys:
+            cache_keys.append(f"sha256:{hashes['sha256']}")
         
-        # Get file info
-        filename = os.path.basename(filepath)
-        filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
+        if stream:
+            await finish_streamed_upload(client, message, status_msg, upload_msg, stream, filepath, cache_keys, token)
+            return
         
-        # Ask for rename
-        text = (
-            f"✅ **Download Complete!**\n\n"
-            f"📁 **File:** `{filename}`\n"
-            f"💾 **Size:** {humanbytes(filesize)}\n\n"
-            f"Do you want to rename this file?"
-        )
+        if early['sequential']:
+            await finish_early_uploads(client, message, status_msg, filepath, token, early)
+            return
         
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✏️ Rename Now", callback_data="rename_now")],
-            [InlineKeyboardButton("⏭️ Skip Rename", callback_data="rename_skip")]
-        ])
+        # Downloaded - the task now waits for rename/upload
+        task = user_tasks.get(user_id)
+        if task and task.get('token') is token:
+            task['filepath'] = filepath
+            task['busy'] = False
+        else:
+            user_tasks[user_id] = {
+                'filepath': filepath,
+                'url': url if isinstance(url, str) else 'torrent',
+                'cache_keys': cache_keys,
+                'waiting_rename': False
+            }
         
-        await status_msg.edit_text(text, reply_markup=keyboard)
+        # Ask for rename
+        filename, filesize = await ask_rename(status_msg, filepath, hashes, checksum)
         
         # Log to channel
         try:
@@ -916,13 +1163,418 @@ async def process_download(client, message: Message, url):
             pass
             
     except Exception as e:
+        task = user_tasks.get(user_id)
+        if task and task.get('busy') and not task.get('filepath'):
+            drop_task(user_id, task.get('token'))
         await status_msg.edit_text(
             f"❌ **Error:** {str(e)[:300]}\n\n"
             f"Something went wrong. Please try again."
         )
         await db.log_action(user_id, "error", str(e))
 
+async def ask_rename(status_msg, filepath, hashes=None, checksum=None):
+    """Show the finished download and offer a rename before the upload - returns (filename, filesize)"""
+    filename = os.path.basename(filepath)
+    filesize = get_path_size(filepath)
+    
+    text = (
+        f"✅ **Download Complete!**\n\n"
+        f"📁 **File:** `{filename}`\n"
+        + (f"🗂 **Files:** {sum(len(names) for _, _, names in os.walk(filepath))}\n" if os.path.isdir(filepath) else "")
+        + f"💾 **Size:** {humanbytes(filesize)}\n"
+        + (f"🔐 **SHA-256:** `{hashes['sha256']}`\n" if hashes else "")
+        + ("✅ **Checksum verified**\n" if checksum else "")
+        + "\nDo you want to rename this file?"
+    )
+    
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ Rename Now", callback_data="rename_now")],
+        [InlineKeyboardButton("⏭️ Skip Rename", callback_data="rename_skip")]
+    ])
+    
+    await status_msg.edit_text(text, reply_markup=keyboard)
+    return filename, filesize
+    
+async def ask_file_selection(status_msg, user_id, files):
+    """Show a torrent's files and wait for the user's choice - returns (torrent file indices, sequential)"""
+    future = asyncio.get_running_loop().create_future()
+    task = user_tasks.get(user_id)
+    if task is not None:
+        task['file_choice'] = {'future': future, 'files': files}
+        
+    shown = files[:40]
+    lines = [
+        f"`{i + 1}.` {truncate_text(os.path.basename(f['path']), 50)} - {humanbytes(f['size'])}"
+        for i, f in enumerate(shown)
+    ]
+    if len(files) > len(shown):
+        lines.append(f"... and {len(files) - len(shown)} more")
+        
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📥 All files", callback_data="files_all")],
+        [InlineKeyboardButton("▶️ All, in order", callback_data="files_seq")]
+    ])
+    
+    await status_msg.edit_text(
+        f"🧲 **Torrent has {len(files)} files** ({humanbytes(sum(f['size'] for f in files))})\n\n"
+        + "\n".join(lines)
+        + "\n\n📝 Send numbers like `1,3,5-7` or `all`.\n"
+        "▶️ Add `seq` to download them in order - each file is uploaded as soon as it's done.",
+        reply_markup=keyboard
+    )
+    
+    try:
+        chosen, sequential = await asyncio.wait_for(future, Config.TORRENT_SELECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        # No answer - download everything
+        chosen, sequential = set(range(len(files))), False
+    finally:
+        if task is not None:
+            task.pop('file_choice', None)
+            
+    await status_msg.edit_text(
+        f"🧲 **{len(chosen)} of {len(files)} files selected**"
+        + (" - in order" if sequential else "")
+        + "\n\nStarting download..."
+    )
+    return {files[i]['index'] for i in chosen}, sequential
+    
+async def upload_torrent_file(client, message: Message, path, token, state):
+    """Upload one finished file of a sequential torrent while the rest still downloads"""
+    user_id = message.from_user.id
+    if token.cancelled:
+        return
+    settings = user_settings.get(user_id, {})
+    
+    bandwidth.join(user_id)
+    try:
+        filename = os.path.basename(path)
+        caption = settings.get('caption',
+            f"📁 **{filename}**\n\n"
+            f"💾 **Size:** {humanbytes(os.path.getsize(path))}\n"
+            f"⚡ **Powered by:** {Config.DEVELOPER}"
+        )
+        
+        if state['msg'] is None:
+            state['msg'] = await message.reply_text("⬆️ **Uploading files as they finish...**")
+        progress = Progress(client, state['msg'])
+        upload_progress = bandwidth.throttled_progress(user_id, progress.progress_callback)
+        
+        await upload_file(
+            client, message.chat.id, path, 'original', caption, settings.get('thumbnail'),
+            cancellable_progress(client, token, upload_progress)
+        )
+        if not token.cancelled:
+            state['sent'] += 1
+            
+    except Exception as e:
+        state['failed'] += 1
+        print(f"Torrent file upload error for user {user_id}: {e}")
+        
+    finally:
+        bandwidth.leave(user_id)
+        
+async def finish_early_uploads(client, message: Message, status_msg, filepath, token, state):
+    """Wait for the last per-file upload of a sequential torrent, then wrap up like a normal upload"""
+    user_id = message.from_user.id
+    try:
+        if state['upload']:
+            await state['upload']
+        if state['msg']:
+            try:
+                await state['msg'].delete()
+            except:
+                pass
+                
+        if token.cancelled:
+            await status_msg.edit_text(f"🛑 **Upload Cancelled!**\n\n📤 Sent {state['sent']} files.")
+            return
+            
+        await complete_upload(client, status_msg, message.from_user, filepath, get_path_size(filepath), 'original')
+        if state['failed']:
+            await message.reply_text(
+                f"⚠️ **{state['failed']} file(s) failed to upload** - {state['sent']} sent."
+            )
+    finally:
+        downloader.cleanup(filepath)
+        drop_task(user_id, token)
+
+async def resume_torrent_job(client, job):
+    """Continue a torrent that was unfinished when the bot stopped, for the user who started it"""
+    user_id = job.get('user_id')
+    source = job.get('source')
+    if not user_id or not source:
+        return
+        
+    try:
+        status_msg = await client.send_message(
+            user_id,
+            "♻️ **Resuming your torrent after a restart...**\n\n"
+            "Pieces downloaded before are kept."
+        )
+    except Exception as e:
+        print(f"Torrent resume notification failed for user {user_id}: {e}")
+        return
+        
+    token = CancelToken()
+    user_tasks[user_id] = {
+        'token': token,
+        'busy': True,
+        'filepath': None,
+        'url': source,
+        'cache_keys': [downloader.job_key(source)],
+        'waiting_rename': False
+    }
+    
+    try:
+        progress = Progress(client, status_msg)
+        filepath, error = await downloader.download(
+            source,
+            progress_callback=progress.progress_callback,
+            user_id=user_id,
+            cancel_token=token
+        )
+        
+        if token.cancelled and not error:
+            downloader.cleanup(filepath)
+            error = "Download cancelled"
+            
+        if error:
+            drop_task(user_id, token)
+            if token.cancelled:
+                await status_msg.edit_text("🛑 **Download Cancelled!**")
+            else:
+                await status_msg.edit_text(
+                    f"❌ **Download Failed!**\n\n"
+                    f"**Error:** {error}"
+                )
+            return
+            
+        await db.update_stats(user_id, download=True)
+        await db.log_action(user_id, "download", "torrent (resumed)")
+        
+        # Downloaded - the task now waits for rename/upload
+        task = user_tasks.get(user_id)
+        if task and task.get('token') is token:
+            task['filepath'] = filepath
+            task['busy'] = False
+        else:
+            user_tasks[user_id] = {
+                'filepath': filepath,
+                'url': source,
+                'cache_keys': [downloader.job_key(source)],
+                'waiting_rename': False
+            }
+            
+        await ask_rename(status_msg, filepath, downloader.file_hashes.get(filepath))
+        
+    except Exception as e:
+        task = user_tasks.get(user_id)
+        if task and task.get('busy') and not task.get('filepath'):
+            drop_task(user_id, token)
+        await status_msg.edit_text(
+            f"❌ **Error:** {str(e)[:300]}\n\n"
+            f"Something went wrong. Please try again."
+        )
+        await db.log_action(user_id, "error", str(e))
+
+async def process_playlist(client, message: Message, status_msg, url, playlist, token):
+    """Download a playlist's entries a few at a time and upload each one as soon as it's done"""
+    user_id = message.from_user.id
+    settings = user_settings.get(user_id, {})
+    thumbnail = settings.get('thumbnail')
+    entries = playlist['entries']
+    
+    progress = PlaylistProgress(client, status_msg, playlist['title'], [entry['title'] for entry in entries])
+    slots = asyncio.Semaphore(Config.PLAYLIST_CONCURRENCY)
+    await progress.refresh(force=True)
+    
+    async def run_item(index, entry):
+        async with slots:
+            if token.cancelled:
+                progress.set(index, 'cancelled')
+                return
+                
+            # Entries sent before go out by file_id
+            cache_keys = [downloader.job_key(entry['url'])]
+            if not thumbnail:
+                cached = await db.get_cached_file(cache_keys, 'original')
+                if cached:
+                    caption = settings.get('caption',
+                        f"📁 **{cached['file_name']}**\n\n"
+                        f"💾 **Size:** {humanbytes(cached['file_size'])}\n"
+                        f"⚡ **Powered by:** {Config.DEVELOPER}"
+                    )
+                    if await send_from_cache(client, message.chat.id, cached, caption):
+                        progress.set(index, 'cached')
+                        return
+                        
+            progress.set(index, 'downloading')
+            filepath, error = await downloader.download(
+                entry['url'],
+                progress_callback=progress.item_callback(index),
+                user_id=user_id,
+                cancel_token=token
+            )
+            if token.cancelled and not error:
+                downloader.cleanup(filepath)
+                error = "Download cancelled"
+            if error:
+                progress.set(index, 'cancelled' if token.cancelled else 'failed', error)
+                return
+                
+            bandwidth.join(user_id)
+            try:
+                filename = os.path.basename(filepath)
+                filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
+                caption = settings.get('caption',
+                    f"📁 **{filename}**\n\n"
+                    f"💾 **Size:** {humanbytes(filesize)}\n"
+                    f"⚡ **Powered by:** {Config.DEVELOPER}"
+                )
+                
+                progress.set(index, 'uploading')
+                upload_progress = bandwidth.throttled_progress(user_id, progress.item_callback(index))
+                sent = await upload_file(
+                    client, message.chat.id, filepath, 'original', caption, thumbnail,
+                    cancellable_progress(client, token, upload_progress)
+                )
+                if token.cancelled:
+                    progress.set(index, 'cancelled')
+                    return
+                    
+                if not thumbnail:
+                    file_id, media_type = get_media_file_id(sent)
+                    await db.cache_file(cache_keys, file_id, media_type, 'original', filename, filesize)
+                progress.set(index, 'done')
+                await db.update_stats(user_id, download=True, upload=True)
+                
+            except Exception as e:
+                progress.set(index, 'failed', str(e))
+                print(f"Playlist item upload error for user {user_id}: {e}")
+                
+            finally:
+                bandwidth.leave(user_id)
+                downloader.cleanup(filepath)
+                await progress.refresh()
+                
+    try:
+        await asyncio.gather(*(run_item(index, entry) for index, entry in enumerate(entries)))
+        await progress.refresh(force=True)
+        
+        sent = sum(1 for item in progress.items if item['state'] in ('done', 'cached'))
+        await db.log_action(user_id, "playlist", f"{url} ({sent}/{len(entries)})")
+        if token.cancelled:
+            await message.reply_text(f"🛑 **Playlist Cancelled!**\n\n📤 Sent {sent} of {len(entries)} items.")
+            return
+            
+        # One cooldown for the whole playlist
+        user_cooldowns[user_id] = time.time()
+        success_msg = await message.reply_text(
+            f"✅ **Playlist Complete!**\n\n"
+            f"📤 Sent {sent} of {len(entries)} items.\n"
+            f"⏳ You can send new task after **{format_time(get_remaining_time(user_id))}**"
+        )
+        asyncio.create_task(cooldown_refresh_message(client, success_msg, user_id))
+        
+        try:
+            await client.send_message(
+                Config.LOG_CHANNEL,
+                f"📃 **New Playlist**\n\n"
+                f"👤 User: {message.from_user.mention}\n"
+                f"📁 Playlist: `{playlist['title']}`\n"
+                f"📤 Sent: {sent} / {len(entries)}\n"
+                f"🔗 Source: `{url}`"
+            )
+        except:
+            pass
+            
+    finally:
+        drop_task(user_id, token)
+
+async def finish_streamed_upload(client, message: Message, status_msg, upload_msg, stream, filepath, cache_keys, token):
+    """Complete a streaming-mode job: send the streamed file (or upload it now if it was too small)"""
+    user_id = message.from_user.id
+    settings = user_settings.get(user_id, {})
+    thumbnail = settings.get('thumbnail')
+    
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
+    
+    caption = settings.get('caption', 
+        f"📁 **{filename}**\n\n"
+        f"💾 **Size:** {humanbytes(filesize)}\n"
+        f"⚡ **Powered by:** {Config.DEVELOPER}"
+    )
+    
+    try:
+        await status_msg.edit_text(
+            f"✅ **Download Complete!**\n\n"
+            f"📁 **File:** `{filename}`\n"
+            f"💾 **Size:** {humanbytes(filesize)}\n\n"
+            f"⬆️ Finishing upload..."
+        )
+        
+        if stream.started:
+            try:
+                sent = await stream.finish(caption)
+            except asyncio.CancelledError:
+                # /cancel aborted the part uploads
+                if not token.cancelled:
+                    raise
+        else:
+            progress = Progress(client, upload_msg)
+            upload_progress = bandwidth.throttled_progress(user_id, progress.progress_callback)
+            sent = await upload_file(
+                client, message.chat.id, filepath, 'original', caption, thumbnail,
+                cancellable_progress(client, token, upload_progress)
+            )
+        
+        if token.cancelled:
+            await upload_msg.edit_text("🛑 **Upload Cancelled!**")
+            return
+        
+        if not thumbnail:
+            file_id, media_type = get_media_file_id(sent)
+            await db.cache_file(cache_keys, file_id, media_type, 'original', filename, filesize)
+        
+        try:
+            await status_msg.delete()
+        except:
+            pass
+        await complete_upload(client, upload_msg, message.from_user, filepath, filesize, 'original')
+        
+    except Exception as e:
+        stream.abort()
+        await upload_msg.edit_text(
+            f"❌ **Upload Failed!**\n\n"
+            f"**Error:** {str(e)[:200]}"
+        )
+        print(f"Streamed upload error for user {user_id}: {e}")
+    
+    finally:
+        downloader.cleanup(filepath)
+        drop_task(user_id, token)
+
 # Settings commands
+@app.on_message(filters.command("stream") & filters.private)
+async def stream_command(client, message: Message):
+    await add_reaction(message)
+    
+    user_id = message.from_user.id
+    if user_id not in user_settings:
+        user_settings[user_id] = {}
+    user_settings[user_id]['stream'] = not user_settings[user_id].get('stream')
+    
+    if user_settings[user_id]['stream']:
+        await message.reply_text(
+            "✅ **Streaming upload enabled!**\n\n"
+            "Files upload while they download, in their original format.\n"
+            "The rename and upload type steps are skipped."
+        )
+    else:
+        await message.reply_text("✅ **Streaming upload disabled!**")
+
 @app.on_message(filters.command("setname") & filters.private)
 async def setname_command(client, message: Message):
     await add_reaction(message)
@@ -1053,6 +1705,11 @@ async def total_command(client, message: Message):
     await add_reaction(message)
     
     stats = await db.get_stats()
+    http_stats = downloader.get_http_stats()
+    cache_stats = await db.get_file_cache_stats()
+    disk_stats = disk_space.stats()
+    buffer_stats = downloader.get_buffer_stats()
+    pool_stats = ytdlp_pool.get_stats()
     
     text = f"""📈 **Bot Statistics**
 
@@ -1063,6 +1720,24 @@ async def total_command(client, message: Message):
 • Total Downloads: {stats['total_downloads']}
 • Total Uploads: {stats['total_uploads']}
 
+🌐 **HTTP Pool:**
+• Connections: {http_stats['connections_created']} new / {http_stats['connections_reused']} reused
+• DNS Cache: {http_stats['dns_cache_hits']} hits / {http_stats['dns_cache_misses']} misses
+• Buffers: {humanbytes(buffer_stats['in_flight'])} in flight, {humanbytes(buffer_stats['peak'])} peak of {humanbytes(buffer_stats['limit'])}
+• Chunk Size: {humanbytes(buffer_stats['chunk_size'])} ({buffer_stats['readers']} readers, {buffer_stats['waits']} waits)
+
+♻️ **File Cache:**
+• Entries: {cache_stats['entries']}
+• Hits: {cache_stats['hits']} / Misses: {cache_stats['misses']}
+
+🎬 **yt-dlp Workers:**
+• Busy: {pool_stats['busy']} / Idle: {pool_stats['idle']} (max {pool_stats['size']})
+• Jobs: {pool_stats['jobs']} • Restarts: {pool_stats['recycled']} recycled, {pool_stats['killed']} killed
+
+💽 **Disk:**
+• Free: {humanbytes(disk_stats['free'])} ({humanbytes(disk_stats['pending'])} reserved)
+• Jobs holding space: {disk_stats['jobs']} / Rejected: {disk_stats['rejected']}
+
 ⚙️ **Bot Info:**
 • Speed: Up to 500 MB/s
 • Max Size: 4 GB
@@ -1074,6 +1749,34 @@ async def total_command(client, message: Message):
     
     await message.reply_text(text)
 
+# Bandwidth limits (owner only) - applied to running jobs immediately
+@app.on_message(filters.command("setlimit") & filters.user(Config.OWNER_ID))
+async def setlimit_command(client, message: Message):
+    await add_reaction(message)
+    
+    if len(message.command) < 2:
+        stats = bandwidth.stats()
+        await message.reply_text(
+            "**Usage:** `/setlimit <download MB/s> [upload MB/s]`\n"
+            "Use `0` for unlimited.\n\n"
+            f"⬇️ **Download:** {humanbytes(stats['rates']['download']) + '/s' if stats['rates']['download'] else 'Unlimited'}\n"
+            f"⬆️ **Upload:** {humanbytes(stats['rates']['upload']) + '/s' if stats['rates']['upload'] else 'Unlimited'}\n"
+            f"👥 **Active users:** {len(stats['users'])}"
+        )
+        return
+    
+    try:
+        limits = [float(value) for value in message.command[1:3]]
+    except ValueError:
+        await message.reply_text("❌ **Limits must be numbers (MB/s)!**")
+        return
+    
+    bandwidth.set_rate('download', limits[0] * 1024 * 1024)
+    if len(limits) > 1:
+        bandwidth.set_rate('upload', limits[1] * 1024 * 1024)
+    
+    await message.reply_text("✅ **Bandwidth limits updated!**")
+
 # Broadcast (owner only)
 @app.on_message(filters.command("broadcast") & filters.user(Config.OWNER_ID))
 async def broadcast_command(client, message: Message):
@@ -1141,12 +1844,16 @@ async def cancel_command(client, message: Message):
         task = user_tasks[user_id]
         filepath = task.get('filepath')
         
-        # Clean up file
-        if filepath:
-            downloader.cleanup(filepath)
-        
-        # Remove task
-        del user_tasks[user_id]
+        if task.get('busy'):
+            # Stop the running transfer - it frees its own file and disk space
+            task['token'].cancel()
+        else:
+            # Clean up file
+            if filepath:
+                downloader.cleanup(filepath)
+            
+            # Remove task
+            del user_tasks[user_id]
         
         await message.reply_text(
             "✅ **Task cancelled successfully!**\n\n"
@@ -1188,6 +1895,18 @@ async def unknown_command(client, message: Message):
 # Startup message
 async def startup():
     """Send startup notification"""
+    try:
+        await db.ensure_indexes()
+    except Exception as e:
+        print(f"Index creation failed: {e}")
+    
+    # Build the host -> extractor index off the event loop instead of on the first URL
+    await asyncio.get_running_loop().run_in_executor(None, router.build_index)
+    
+    # Torrents that were still downloading when the bot stopped continue where they left off
+    for job in torrent_session.saved_jobs():
+        asyncio.create_task(resume_torrent_job(app, job))
+    
     try:
         await app.send_message(
             Config.OWNER_ID,
@@ -1214,6 +1933,10 @@ async def shutdown():
     
     user_tasks.clear()
     
+    # Release pooled HTTP connections
+    await downloader.close()
+    await media_sessions.close()
+    
     try:
         await app.send_message(
             Config.OWNER_ID,
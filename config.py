@@ -30,14 +30,77 @@ class Config:
     # Download/Upload settings
     MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 4 GB
     SPEED_LIMIT = 500 * 1024 * 1024  # 500 MB/s (SUPER FAST!)
+    UPLOAD_SPEED_LIMIT = int(os.environ.get("UPLOAD_SPEED_LIMIT", str(100 * 1024 * 1024)))  # Separate uplink budget
     CHUNK_SIZE = 2 * 1024 * 1024  # 2 MB chunks for maximum speed
     
+    # Segmented HTTP downloads (used when the server supports byte ranges)
+    DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+    SEGMENT_MIN_SIZE = 8 * 1024 * 1024  # Don't split into segments smaller than 8 MB
+    
+    # Shared HTTP connection pool
+    HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", "100"))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "30"))
+    
+    # Write-behind disk writer: max chunks queued per download before the reader waits
+    WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "16"))
+    
+    # Ceiling for chunk memory held by all downloads together (chunks shrink as jobs are added)
+    BUFFER_BUDGET = int(os.environ.get("BUFFER_BUDGET", str(256 * 1024 * 1024)))
+    
+    # URL preflight cache (HEAD results)
+    PROBE_CACHE_SIZE = 512
+    PROBE_CACHE_TTL = 600  # seconds
+    
+    # Engine router - per-host extractor lookups
+    ROUTE_CACHE_SIZE = 2048
+    ROUTE_CACHE_TTL = 24 * 3600  # seconds
+    
+    # Automatic resume of interrupted HTTP transfers
+    DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", "5"))
+    RETRY_MAX_DELAY = 30  # Cap for the exponential backoff between resumes (seconds)
+    
+    # Pipelined download-to-upload streaming (/stream)
+    STREAM_MIN_SIZE = 20 * 1024 * 1024  # Smaller files just upload after the download
+    UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "8"))  # Parts in flight per upload
+    UPLOAD_SESSIONS = int(os.environ.get("UPLOAD_SESSIONS", "4"))  # Media sessions the parts are spread over
+    
+    # Multi-file torrents - every file is uploaded on its own, a few at a time, as albums
+    FOLDER_UPLOAD_CONCURRENCY = int(os.environ.get("FOLDER_UPLOAD_CONCURRENCY", "3"))  # Files in flight
+    
+    # Telegram file_id cache - resend known files instead of uploading them again
+    FILE_CACHE_TTL_DAYS = int(os.environ.get("FILE_CACHE_TTL_DAYS", "30"))
+    
+    # yt-dlp worker processes (extraction runs outside the bot process)
+    YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", str(os.cpu_count() or 2)))
+    YTDLP_WORKER_MAX_JOBS = int(os.environ.get("YTDLP_WORKER_MAX_JOBS", "50"))  # Recycle after this many jobs
+    YTDLP_STALL_TIMEOUT = int(os.environ.get("YTDLP_STALL_TIMEOUT", "600"))  # Kill a worker silent this long
+    
+    # yt-dlp metadata cache (extraction is reused by the download)
+    YTDLP_INFO_CACHE_SIZE = 256
+    YTDLP_INFO_CACHE_TTL = 600  # seconds - format URLs expire
+    
+    # Playlist/channel links - entries are downloaded and uploaded individually
+    PLAYLIST_CONCURRENCY = int(os.environ.get("PLAYLIST_CONCURRENCY", "3"))  # Items in flight per playlist
+    PLAYLIST_MAX_ITEMS = int(os.environ.get("PLAYLIST_MAX_ITEMS", "100"))
+    
+    # Disk space admission - jobs reserve their size before downloading
+    DISK_FREE_MARGIN = int(os.environ.get("DISK_FREE_MARGIN", str(512 * 1024 * 1024)))  # Always keep free
+    DISK_WAIT_TIMEOUT = int(os.environ.get("DISK_WAIT_TIMEOUT", "900"))  # Max queueing for space (seconds)
+    
     # Download directory
     DOWNLOAD_DIR = "downloads"
     
     # Torrent settings
     TORRENT_DOWNLOAD_PATH = "downloads/torrents"
     TORRENT_SEED_TIME = 0  # Don't seed after download
+    TORRENT_LISTEN = os.environ.get("TORRENT_LISTEN", "0.0.0.0:6881,[::]:6881")  # One session for all torrents
+    TORRENT_CONNECTIONS = int(os.environ.get("TORRENT_CONNECTIONS", "800"))  # Peer connections across all torrents
+    TORRENT_STATE_FILE = "downloads/torrents/.session_state"  # DHT routing table, reloaded on startup
+    TORRENT_RESUME_DIR = "downloads/torrents/.resume"  # Fast-resume data of unfinished torrents
+    TORRENT_RESUME_INTERVAL = int(os.environ.get("TORRENT_RESUME_INTERVAL", "60"))  # Seconds between saves
+    TORRENT_SELECT_TIMEOUT = 300  # Wait this long for a file choice, then take every file
+    TORRENT_METADATA_DIR = "downloads/torrents/.metadata"  # .torrent metadata by infohash - repeat magnets skip the fetch
+    TORRENT_METADATA_CACHE_SIZE = int(os.environ.get("TORRENT_METADATA_CACHE_SIZE", "1000"))  # Files kept
     
     # Welcome message
     START_MESSAGE = """ʜᴇʏ {name}**, 
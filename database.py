@@ -1,5 +1,5 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
+from datetime import datetime, timedelta
 from config import Config
 
 class Database:
@@ -8,6 +8,8 @@ class Database:
         self.db = self.client['telegram_bot']
         self.users = self.db['users']
         self.logs = self.db['logs']
+        self.file_cache = self.db['file_cache']
+        self.file_cache_stats = {'hits': 0, 'misses': 0}
         
     async def add_user(self, user_id, username=None, first_name=None):
         """Add or update user in database"""
@@ -91,4 +93,73 @@ class Database:
             'total_uploads': 0
         }
 
+    async def ensure_indexes(self):
+        """Create indexes used by the file_id cache (idempotent)"""
+        await self.file_cache.create_index('keys')
+        await self.file_cache.create_index('expires_at', expireAfterSeconds=0)
+        
+    async def get_cached_file(self, keys, upload_type=None, file_name=None):
+        """Find a previously uploaded Telegram file by source URL, infohash or content hash"""
+        keys = [key for key in keys if key]
+        if not keys:
+            return None
+        
+        query = {'keys': {'$in': keys}, 'expires_at': {'$gt': datetime.now()}}
+        if upload_type:
+            query['upload_type'] = upload_type
+        if file_name:
+            query['file_name'] = file_name
+        
+        entry = await self.file_cache.find_one(query, sort=[('last_used', -1)])
+        if entry:
+            self.file_cache_stats['hits'] += 1
+            await self.file_cache.update_one(
+                {'_id': entry['_id']},
+                {'$set': {'last_used': datetime.now()}, '$inc': {'hits': 1}}
+            )
+        else:
+            self.file_cache_stats['misses'] += 1
+        return entry
+        
+    async def cache_file(self, keys, file_id, media_type, upload_type, file_name, file_size):
+        """Remember the Telegram file_id of an upload so it can be resent without uploading"""
+        keys = [key for key in keys if key]
+        if not keys or not file_id:
+            return
+        
+        now = datetime.now()
+        try:
+            # $elemMatch keeps the filter off 'keys' on insert - a one-key $in counts as an
+            # equality and would seed 'keys' as a scalar that $addToSet can't extend
+            await self.file_cache.update_one(
+                {'keys': {'$elemMatch': {'$in': keys}}, 'upload_type': upload_type, 'file_name': file_name},
+                {
+                    '$set': {
+                        'file_id': file_id,
+                        'media_type': media_type,
+                        'file_size': file_size,
+                        'last_used': now,
+                        'expires_at': now + timedelta(days=Config.FILE_CACHE_TTL_DAYS)
+                    },
+                    '$addToSet': {'keys': {'$each': keys}},
+                    '$setOnInsert': {'created': now, 'hits': 0}
+                },
+                upsert=True
+            )
+        except Exception as e:
+            # The file is already sent - a cache miss later is the only cost
+            print(f"File cache write failed: {e}")
+        
+    async def invalidate_cached_file(self, file_id):
+        """Drop a cache entry whose file_id Telegram no longer accepts"""
+        await self.file_cache.delete_many({'file_id': file_id})
+        
+    async def get_file_cache_stats(self):
+        """Get file_id cache hit/miss counters and size"""
+        return {
+            'hits': self.file_cache_stats['hits'],
+            'misses': self.file_cache_stats['misses'],
+            'entries': await self.file_cache.count_documents({})
+        }
+
 db = Database()
@@ -0,0 +1,102 @@
+import os
+import time
+import shutil
+import asyncio
+from config import Config
+from helpers import humanbytes
+
+class DiskSpaceLedger:
+    """In-process reservations against the free space of the download volume.
+    
+    A job reserves its expected size before transferring anything. Free space minus
+    every reservation still being downloaded must cover it (plus a safety margin),
+    otherwise the job waits until other jobs release space, or is rejected right away
+    when it could never fit. Once a download finishes its bytes are on disk, so the
+    reservation is settled (no longer counted) and finally released on cleanup.
+    """
+
+    def __init__(self, path, margin=0):
+        self.path = path
+        self.margin = margin
+        self.reservations = {}  # key -> {'size', 'settled'}
+        self.changed = None
+        self.rejected = 0
+
+    def free_space(self):
+        """Bytes free on the volume right now"""
+        os.makedirs(self.path, exist_ok=True)
+        return shutil.disk_usage(self.path).free
+
+    def pending(self):
+        """Reserved bytes that haven't reached the disk yet"""
+        return sum(r['size'] for r in self.reservations.values() if not r['settled'])
+
+    def available(self):
+        """Bytes a new job may still reserve"""
+        return self.free_space() - self.pending() - self.margin
+
+    async def reserve(self, key, size, on_wait=None, timeout=None):
+        """Reserve size bytes for key, waiting for space if needed.
+        
+        Returns None on success or an error message. on_wait(needed, available) is awaited
+        whenever the job has to queue.
+        """
+        if key in self.reservations:
+            return None
+            
+        size = max(0, int(size or 0))
+        if self.changed is None:
+            self.changed = asyncio.Event()
+            
+        # Everything our own jobs hold comes back eventually - anything beyond that never fits
+        if size + self.margin > self.free_space() + sum(r['size'] for r in self.reservations.values()):
+            self.rejected += 1
+            return f"Not enough disk space ({humanbytes(size)} needed, {humanbytes(self.available())} free)"
+            
+        deadline = time.monotonic() + (timeout or Config.DISK_WAIT_TIMEOUT)
+        while True:
+            available = self.available()
+            if size <= available:
+                self.reservations[key] = {'size': size, 'settled': False}
+                return None
+                
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.rejected += 1
+                return f"Timed out waiting for disk space ({humanbytes(size)} needed)"
+            if on_wait:
+                await on_wait(size, max(0, available))
+                
+            # Re-check when a job releases space, and every few seconds for outside changes
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), min(remaining, 5))
+            except asyncio.TimeoutError:
+                pass
+
+    def settle(self, key):
+        """The download finished - its bytes are counted by the filesystem from now on"""
+        reservation = self.reservations.get(key)
+        if reservation and not reservation['settled']:
+            reservation['settled'] = True
+            self._notify()
+
+    def release(self, key):
+        """Drop the reservation of key - the job failed or its file was cleaned up"""
+        if self.reservations.pop(key, None) is not None:
+            self._notify()
+
+    def stats(self):
+        """Current ledger state for status displays"""
+        return {
+            'free': self.free_space(),
+            'pending': self.pending(),
+            'jobs': len(self.reservations),
+            'rejected': self.rejected
+        }
+
+    def _notify(self):
+        if self.changed:
+            self.changed.set()
+
+disk_space = DiskSpaceLedger(Config.DOWNLOAD_DIR, Config.DISK_FREE_MARGIN)
@@ -1,12 +1,24 @@
 import os
+import glob
 import aiohttp
 import asyncio
 import yt_dlp
 import libtorrent as lt
 from config import Config
-from helpers import sanitize_filename
+from helpers import sanitize_filename, normalize_url, TTLCache, get_magnet_infohash
+from bandwidth import bandwidth
+from diskspace import disk_space
+from router import router
+from ytdlp_pool import ytdlp_pool, WorkerError
+from torrents import torrent_session
+from urllib.parse import unquote
 import time
 import shutil
+import queue
+import collections
+import base64
+import hashlib
+import threading
 
 # Auxiliary function for formatting file sizes
 def format_bytes(size):
@@ -19,6 +31,460 @@ def format_bytes(size):
         n += 1
     return f"{size:.2f} {units[n]}"
 
+def get_total_size(response):
+    """Get the full size of a (possibly partial) response, 0 if unknown"""
+    content_range = response.headers.get('content-range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    return int(response.headers.get('content-length', 0))
+
+def get_validator(response):
+    """Get the strong validator (ETag, else Last-Modified) used for If-Range resumes"""
+    etag = response.headers.get('etag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+def get_disposition_filename(headers):
+    """Extract the filename from a Content-Disposition header, None if absent"""
+    content_disp = headers.get('content-disposition', '')
+    
+    # RFC 5987 form takes precedence: filename*=UTF-8''name.ext
+    if "filename*=" in content_disp:
+        value = content_disp.split("filename*=", 1)[1].split(';')[0].strip().strip('"\'')
+        if "''" in value:
+            value = value.split("''", 1)[1]
+        return unquote(value) or None
+    
+    if 'filename=' in content_disp:
+        return content_disp.split('filename=', 1)[1].split(';')[0].strip().strip('"\'') or None
+    
+    return None
+
+def supports_ranges(response):
+    """Check if the server will honour byte-range requests"""
+    return (
+        response.status == 206
+        or response.headers.get('accept-ranges', '').lower() == 'bytes'
+    )
+
+# Default headers for every request made through the shared session
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': '*/*',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive'
+}
+
+def build_probe_info(response):
+    """Summarize a HEAD or ranged GET response for the preflight cache"""
+    return {
+        'url': str(response.url),
+        'size': get_total_size(response),
+        'accept_ranges': supports_ranges(response),
+        'content_type': response.content_type,
+        'filename': get_disposition_filename(response.headers)
+    }
+
+def estimate_format_size(fmt, duration=None):
+    """Bytes of one yt-dlp format - exact, approximate or from bitrate x duration"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size) if size else None
+
+def select_ytdlp_format(info, max_size):
+    """Pick the best format (or video+audio pair) whose estimated size fits max_size.
+    
+    Returns (format_spec, size). format_spec is None when yt-dlp's default choice can
+    be kept (playlists, no size information); a size above max_size means even the
+    smallest known option is too big.
+    """
+    formats = info.get('formats') or []
+    if info.get('_type') in ('playlist', 'multi_video') or not formats:
+        return None, None
+    
+    duration = info.get('duration')
+    # yt-dlp sorts formats worst to best, so the index is the quality rank
+    videos, audios, combined = [], [], []
+    best = {}
+    for rank, fmt in enumerate(formats):
+        has_video = fmt.get('vcodec') not in (None, 'none')
+        has_audio = fmt.get('acodec') not in (None, 'none')
+        kind = 'combined' if has_video and has_audio else 'video' if has_video else 'audio' if has_audio else None
+        if kind is None or not fmt.get('format_id'):
+            continue
+        size = estimate_format_size(fmt, duration)
+        best[kind] = size
+        if size is None:
+            continue
+        {'combined': combined, 'video': videos, 'audio': audios}[kind].append((rank, fmt['format_id'], size))
+    
+    # The default choice can't be sized - keep it rather than downgrading blindly
+    default = [best.get('video'), best.get('audio')] if 'video' in best and 'audio' in best else [best.get('combined')]
+    if None in default:
+        return None, None
+    
+    candidates = [((rank, -1), format_id, size) for rank, format_id, size in combined]
+    candidates += [
+        ((v_rank, a_rank), f"{v_id}+{a_id}", v_size + a_size)
+        for v_rank, v_id, v_size in videos
+        for a_rank, a_id, a_size in audios
+    ]
+    if not candidates:
+        return None, None
+    
+    # Leave ~2% for container overhead when streams are merged
+    fitting = [c for c in candidates if c[2] * 1.02 <= max_size]
+    if not fitting:
+        return None, min(size for _, _, size in candidates)
+    
+    _, format_spec, size = max(fitting, key=lambda c: c[0])
+    return format_spec, size
+
+class DownloadError(Exception):
+    """Download failure whose message is shown to the user as-is"""
+
+# Mid-stream failures that are worth resuming with a Range request
+RESUMABLE_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+class BufferBudget:
+    """Global ceiling on chunk memory held by every HTTP download at once.
+    
+    Readers acquire() a chunk's size before reading it from the socket; the bytes are
+    released once the DiskWriter has written them. Chunk sizes shrink as more readers
+    share the budget, so many concurrent jobs keep flowing instead of queueing.
+    """
+    
+    MIN_CHUNK = 64 * 1024
+    MAX_CHUNK = 1024 * 1024
+    CHUNKS_PER_READER = 4  # Room for a few chunks per connection in the write queue
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.readers = 0
+        self.waits = 0
+        self.waiters = collections.deque()
+        
+    def chunk_size(self):
+        """Read size for the next chunk given the current number of readers"""
+        share = self.limit // (max(1, self.readers) * self.CHUNKS_PER_READER)
+        return max(self.MIN_CHUNK, min(self.MAX_CHUNK, share))
+        
+    async def acquire(self, nbytes):
+        """Wait until nbytes fit in the budget (a lone reader always gets through)"""
+        if self.in_flight and self.in_flight + nbytes > self.limit:
+            self.waits += 1
+            while self.in_flight and self.in_flight + nbytes > self.limit:
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                try:
+                    await waiter
+                finally:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+        self.in_flight += nbytes
+        self.peak = max(self.peak, self.in_flight)
+        
+    def release(self, nbytes):
+        """Return nbytes to the budget and let waiting readers re-check"""
+        if nbytes <= 0:
+            return
+        self.in_flight -= nbytes
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'peak': self.peak,
+            'readers': self.readers,
+            'chunk_size': self.chunk_size(),
+            'waits': self.waits
+        }
+
+class DiskWriter:
+    """Write-behind file writer - all disk I/O runs on a dedicated thread.
+    
+    write() only queues the chunk; once Config.WRITE_QUEUE_SIZE chunks are pending it waits,
+    which pushes backpressure onto the network reader instead of blocking the event loop.
+    Queued chunks are returned to buffer_budget once they are on disk.
+    """
+    
+    def __init__(self, filepath, size=None, on_written=None, hasher=None):
+        self.filepath = filepath
+        self.on_written = on_written
+        self.hasher = hasher
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(Config.WRITE_QUEUE_SIZE)
+        self.queue = queue.SimpleQueue()
+        self.finished = self.loop.create_future()
+        self.error = None
+        self.closed = False
+        
+        self.fd = os.open(filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        if size:
+            os.ftruncate(self.fd, size)
+        
+        self.thread = threading.Thread(target=self._run, name=f"writer-{os.path.basename(filepath)}", daemon=True)
+        self.thread.start()
+        
+    async def write(self, offset, data):
+        """Queue data to be written at offset, waiting while the queue is full"""
+        if self.error:
+            raise self.error
+        await self.slots.acquire()
+        self.queue.put((offset, data))
+        
+    async def close(self):
+        """Flush pending chunks, fsync and close the file"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+        await asyncio.shield(self.finished)
+        if self.error:
+            raise self.error
+        
+    def _run(self):
+        """Writer thread: pwrite queued chunks in order, fsync on completion"""
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                offset, data = item
+                try:
+                    if self.error is None:
+                        view = memoryview(data)
+                        while view:
+                            written = os.pwrite(self.fd, view, offset)
+                            view = view[written:]
+                            offset += written
+                        if self.hasher:
+                            self.hasher.update(offset - len(data), len(data), data)
+                        if self.on_written:
+                            # Readable from the page cache now - tell streaming consumers
+                            self._call_in_loop(self.on_written, offset - len(data), len(data))
+                except Exception as e:
+                    self.error = e
+                finally:
+                    self._call_in_loop(self._release, len(data))
+            
+            if self.error is None:
+                os.fsync(self.fd)
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self.fd)
+            if self.hasher:
+                self.hasher.close()
+            self._call_in_loop(self._set_finished)
+            
+    def _release(self, nbytes):
+        self.slots.release()
+        buffer_budget.release(nbytes)
+        
+    def _set_finished(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+            
+    def _call_in_loop(self, callback, *args):
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Event loop already closed (process shutting down)
+            pass
+
+class StreamHasher:
+    """Incremental SHA-256 + MD5 of a file whose byte ranges complete out of order.
+    
+    Ranges arriving at the hash frontier are hashed straight from memory. Ranges completed
+    ahead of it are remembered and read back once the frontier reaches them - they were
+    written moments ago, so that read comes from the page cache, not the disk.
+    Not thread-safe: call update() from a single thread.
+    """
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.offset = 0
+        self.ahead = {}  # offset -> length of ranges on disk past the frontier
+        self.file = None
+        
+    def update(self, offset, length, data=None):
+        """Account bytes offset..offset+length that are on disk (data if still in memory)"""
+        if offset != self.offset:
+            self.ahead[offset] = length
+            return
+        
+        if data is None:
+            self._feed_from_disk(offset, length)
+        else:
+            self._feed(data)
+        self.offset += length
+        
+        while self.offset in self.ahead:
+            length = self.ahead.pop(self.offset)
+            self._feed_from_disk(self.offset, length)
+            self.offset += length
+            
+    def hexdigests(self):
+        """Hashes of everything up to the frontier"""
+        return {'sha256': self.sha256.hexdigest(), 'md5': self.md5.hexdigest()}
+        
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            
+    def _feed(self, data):
+        self.sha256.update(data)
+        self.md5.update(data)
+        
+    def _feed_from_disk(self, offset, length):
+        if self.file is None:
+            self.file = open(self.filepath, 'rb')
+        self.file.seek(offset)
+        while length > 0:
+            data = self.file.read(min(length, 1024 * 1024))
+            if not data:
+                raise IOError(f"Short read while hashing {self.filepath} at {offset}")
+            self._feed(data)
+            length -= len(data)
+
+def hash_file(filepath):
+    """Full-read SHA-256 + MD5 - only for engines that can't hash while downloading"""
+    hasher = StreamHasher(filepath)
+    try:
+        hasher.update(0, os.path.getsize(filepath))
+    finally:
+        hasher.close()
+    return hasher.hexdigests()
+
+def get_server_digests(headers):
+    """Hashes advertised by the server (Digest, Repr-Digest, Content-MD5) as lowercase hex"""
+    digests = {}
+    for header in ('repr-digest', 'digest'):
+        for item in headers.get(header, '').split(','):
+            if '=' not in item:
+                continue
+            algorithm, value = item.strip().split('=', 1)
+            algorithm = algorithm.strip().lower().replace('-', '')
+            if algorithm in ('sha256', 'md5') and algorithm not in digests:
+                try:
+                    digests[algorithm] = base64.b64decode(value.strip().strip(':')).hex()
+                except (ValueError, TypeError):
+                    pass
+    
+    content_md5 = headers.get('content-md5')
+    if content_md5 and 'md5' not in digests:
+        try:
+            digests['md5'] = base64.b64decode(content_md5.strip()).hex()
+        except (ValueError, TypeError):
+            pass
+    return digests
+
+def verify_checksums(actual, expected):
+    """Compare hash dicts, return an error message for the first mismatch or None"""
+    for algorithm, value in expected.items():
+        if algorithm in actual and actual[algorithm] != value.lower():
+            return f"Checksum mismatch ({algorithm.upper()} expected {value.lower()}, got {actual[algorithm]})"
+    return None
+
+def ytdlp_partials(names):
+    """Leftovers of a killed yt-dlp job - reported files with their .part, fragment, .ytdl and merge temp files"""
+    paths = set()
+    for name in names:
+        paths.add(name)
+        final = name[:-5] if name.endswith('.part') else name
+        for suffix in ('.part*', '.ytdl'):
+            paths.update(glob.glob(glob.escape(final) + suffix))
+        # Format files are <title>.f<id>.<ext>; the merger writes <title>.temp.<ext>
+        stem, _ = os.path.splitext(final)
+        if os.path.splitext(stem)[1].startswith('.f'):
+            paths.update(glob.glob(glob.escape(os.path.splitext(stem)[0]) + '.temp.*'))
+    return paths
+
+def set_torrent_flags(p):
+    """Add the job flags to add_torrent_params, keeping the ones already set.
+    
+    libtorrent's defaults include update_subscribe - without it post_torrent_updates()
+    never reports the torrent to the alert dispatcher. Resume data brings its own flags
+    (sequential mode of a resumed job).
+    """
+    p.flags |= lt.torrent_flags.update_subscribe | lt.torrent_flags.auto_managed
+
+def torrent_files(info):
+    """Files of a torrent as [{'index', 'path', 'size'}] - padding files left out"""
+    files = info.files()
+    pad = getattr(lt.file_storage, 'flag_pad_file', 0)
+    return [
+        {'index': i, 'path': files.file_path(i), 'size': files.file_size(i)}
+        for i in range(files.num_files())
+        if not files.file_flags(i) & pad
+    ]
+
+class ProgressTracker:
+    """Aggregate byte counter shared by every connection of one transfer"""
+    
+    def __init__(self, total_size, progress_callback=None, user_id=None):
+        self.total_size = total_size
+        self.user_id = user_id
+        self.downloaded = 0
+        self.progress_callback = progress_callback
+        self.start_time = time.time()
+        self.last_update = 0
+        
+    async def advance(self, nbytes):
+        """Count received bytes and report progress at most once per second"""
+        self.downloaded += nbytes
+        
+        current_time = time.time()
+        if self.progress_callback and (current_time - self.last_update) >= 1:
+            self.last_update = current_time
+            speed = self.downloaded / (current_time - self.start_time) / (1024 * 1024)
+            await self.progress_callback(self.downloaded, self.total_size, f"Downloading ({speed:.1f} MB/s)")
+
+class ProgressCoalescer:
+    """Forward only the newest progress state to an async callback, one call at a time.
+    
+    update() never blocks, so it can sit in a hot hook; from another thread schedule it
+    with loop.call_soon_threadsafe(coalescer.update, ...). States that arrive while the
+    UI is still being edited are collapsed into the latest one.
+    """
+    
+    def __init__(self, callback):
+        self.callback = callback
+        self.state = None
+        self.task = None
+        
+    def update(self, *args, **kwargs):
+        self.state = (args, kwargs)
+        if self.callback and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self._flush())
+            
+    async def _flush(self):
+        while self.state is not None:
+            args, kwargs = self.state
+            self.state = None
+            try:
+                await self.callback(*args, **kwargs)
+            except Exception as e:
+                print(f"Progress callback error: {e}")
+                
+    async def close(self):
+        """Deliver the last pending state"""
+        if self.task:
+            await self.task
+
 class Downloader:
     def __init__(self):
         self.download_dir = Config.DOWNLOAD_DIR
@@ -27,68 +493,240 @@ class Downloader:
             os.makedirs(self.download_dir)
         if not os.path.exists(self.torrent_dir):
             os.makedirs(self.torrent_dir)
+        
+        # Shared HTTP session - keeps DNS cache, keep-alive and TLS sessions across downloads
+        self.session = None
+        self.http_stats = {
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0
+        }
+        
+        # Preflight results keyed by normalized URL
+        self.probe_cache = TTLCache(maxsize=Config.PROBE_CACHE_SIZE, ttl=Config.PROBE_CACHE_TTL)
+        
+        # yt-dlp metadata keyed by normalized URL - reused by the download itself
+        self.ytdlp_info_cache = TTLCache(maxsize=Config.YTDLP_INFO_CACHE_SIZE, ttl=Config.YTDLP_INFO_CACHE_TTL)
+        
+        # Content hashes of finished downloads, keyed by filepath
+        self.file_hashes = {}
+        
+        # Torrents running in the shared libtorrent session, keyed by job key
+        self.torrent_handles = {}
+        
+        # Singleflight: identical requests share one job until its last consumer cleans up
+        self.jobs = {}  # job key -> job dict
+        self.file_jobs = {}  # finished filepath -> job dict
 
-    async def download_file(self, url, filename=None, progress_callback=None):
-        """Download file from URL using aiohttp with maximum speed - preserves original quality"""
-        try:
-            timeout = aiohttp.ClientTimeout(total=None, connect=30, sock_read=30)
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept': '*/*',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Range': 'bytes=0-'
-            }
+    async def get_session(self):
+        """Get the process-wide aiohttp session, creating it on first use"""
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._count_stat('connections_created'))
+            trace_config.on_connection_reuseconn.append(self._count_stat('connections_reused'))
+            trace_config.on_dns_cache_hit.append(self._count_stat('dns_cache_hits'))
+            trace_config.on_dns_cache_miss.append(self._count_stat('dns_cache_misses'))
+            
             connector = aiohttp.TCPConnector(
-                limit=100,
-                limit_per_host=30,
+                limit=Config.HTTP_POOL_LIMIT,
+                limit_per_host=Config.HTTP_POOL_LIMIT_PER_HOST,
                 ttl_dns_cache=300,
+                keepalive_timeout=60,
                 force_close=False,
                 enable_cleanup_closed=True
             )
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, connect=30, sock_read=30),
+                headers=HTTP_HEADERS,
+                connector=connector,
+                trace_configs=[trace_config]
+            )
+        return self.session
+
+    def _count_stat(self, key):
+        """Build an aiohttp trace hook that increments one http_stats counter"""
+        async def hook(session, trace_config_ctx, params):
+            self.http_stats[key] += 1
+        return hook
+
+    def get_http_stats(self):
+        """Connection reuse counters of the shared session"""
+        return dict(self.http_stats)
+
+    def get_buffer_stats(self):
+        """In-flight and peak chunk memory across all HTTP downloads"""
+        return buffer_budget.stats()
+
+    async def close(self):
+        """Close the shared HTTP session, the yt-dlp workers and the torrent session - call once on shutdown"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        await ytdlp_pool.close()
+        
+        # Unfinished torrents stay in the resume data and continue on the next start
+        self.torrent_handles.clear()
+        # Collecting the final resume data blocks for seconds - keep the other handlers running
+        await asyncio.get_running_loop().run_in_executor(None, torrent_session.close)
+
+    async def probe(self, url):
+        """Preflight a URL without downloading its body - cached per normalized URL.
+        
+        Tries HEAD first and falls back to a one-byte ranged GET. Returns a dict with
+        url (after redirects), size, accept_ranges, content_type and filename, or None.
+        """
+        key = normalize_url(url)
+        info = self.probe_cache.get(key)
+        if info is not None:
+            return info
+        
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=20)
+        headers = {'Accept-Encoding': 'identity'}
+        
+        try:
+            async with session.head(url, headers=headers, allow_redirects=True, timeout=timeout) as response:
+                if response.status < 400 and response.headers.get('content-length'):
+                    info = build_probe_info(response)
             
-            async with aiohttp.ClientSession(
-                timeout=timeout, 
-                headers=headers,
-                connector=connector
-            ) as session:
-                async with session.get(url, allow_redirects=True) as response:
-                    if response.status not in (200, 206):
-                        return None, f"Failed to download: HTTP {response.status}"
-                    
-                    total_size = int(response.headers.get('content-length', 0))
-                    
-                    if total_size > Config.MAX_FILE_SIZE:
-                        return None, "File size exceeds 4GB limit"
-                    
-                    if not filename:
-                        content_disp = response.headers.get('content-disposition', '')
-                        if 'filename=' in content_disp:
-                            filename = content_disp.split('filename=')[1].strip('"\'')
-                        else:
-                            filename = url.split('/')[-1].split('?')[0] or 'downloaded_file'
-                    
-                    filename = sanitize_filename(filename)
-                    filepath = os.path.join(self.download_dir, filename)
-                    
-                    downloaded = 0
-                    start_time = time.time()
-                    last_update = 0
-                    chunk_size = 10 * 1024 * 1024
-                    
-                    with open(filepath, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(chunk_size):
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            current_time = time.time()
-                            if progress_callback and (current_time - last_update) >= 1:
-                                last_update = current_time
-                                speed = downloaded / (current_time - start_time) / (1024 * 1024)
-                                await progress_callback(downloaded, total_size, f"Downloading ({speed:.1f} MB/s)")
-                    
-                    return filepath, None
-                    
+            # Many origins reject HEAD or omit the length - ask for a single byte instead
+            if info is None:
+                headers['Range'] = 'bytes=0-0'
+                async with session.get(url, headers=headers, allow_redirects=True, timeout=timeout) as response:
+                    if response.status < 400:
+                        info = build_probe_info(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Probe failed for {url}: {e}")
+            return None
+        
+        if info:
+            self.probe_cache.set(key, info)
+        return info
+
+    async def preflight(self, url_or_file):
+        """Probe direct HTTP links before downloading; torrents only when their metadata is at hand"""
+        if isinstance(url_or_file, str) and (url_or_file.startswith('magnet:') or url_or_file.endswith('.torrent')):
+            return self.torrent_preview(url_or_file)
+        if not isinstance(url_or_file, str) or not url_or_file.lower().startswith(('http://', 'https://')):
+            return None
+        if url_or_file.endswith('.torrent') or self.is_video_url(url_or_file):
+            return None
+        return await self.probe(url_or_file)
+
+    def torrent_preview(self, magnet_or_file):
+        """Name, size and file count of a .torrent file or a magnet in the metadata cache, else None"""
+        info = None
+        if magnet_or_file.startswith('magnet:'):
+            info_hash = get_magnet_infohash(magnet_or_file)
+            if info_hash:
+                info = torrent_session.cached_metadata(info_hash)
+        elif os.path.exists(magnet_or_file):
+            try:
+                info = lt.torrent_info(magnet_or_file)
+            except Exception:
+                return None
+        if info is None:
+            return None
+        return {
+            'url': magnet_or_file,
+            'filename': info.name(),
+            'size': info.total_size(),
+            'content_type': None,
+            'files': len(torrent_files(info))
+        }
+
+    def is_video_url(self, url):
+        """Check if a yt-dlp extractor accepts the URL"""
+        return router.route(url) == 'ytdlp'
+
+    async def download_file(self, url, filename=None, progress_callback=None, user_id=None, stream=None):
+        """Download file from URL using aiohttp with maximum speed - preserves original quality"""
+        filepath = None
+        hasher = None
+        try:
+            session = await self.get_session()
+            # identity: the file as stored - Content-Length then matches the bytes we receive
+            headers = {'Range': 'bytes=0-', 'Accept-Encoding': 'identity'}
+            async with session.get(url, headers=headers, allow_redirects=True) as response:
+                if response.status not in (200, 206):
+                    return None, f"Failed to download: HTTP {response.status}"
+                
+                total_size = get_total_size(response)
+                # A server that encodes anyway sends the Content-Length of the compressed body,
+                # which says nothing about how many decoded bytes arrive
+                encoded = bool(response.headers.get('content-encoding'))
+                
+                if total_size > Config.MAX_FILE_SIZE:
+                    return None, "File size exceeds 4GB limit"
+                
+                if not filename:
+                    filename = (
+                        get_disposition_filename(response.headers)
+                        or unquote(url.split('/')[-1].split('?')[0])
+                        or 'downloaded_file'
+                    )
+                
+                filename = sanitize_filename(filename)
+                filepath = os.path.join(self.download_dir, filename)
+                tracker = ProgressTracker(total_size, progress_callback, user_id)
+                
+                # Segmented mode needs byte ranges, a known size and an unencoded body
+                final_url = str(response.url)
+                segmented = (
+                    Config.DOWNLOAD_CONNECTIONS > 1
+                    and total_size >= 2 * Config.SEGMENT_MIN_SIZE
+                    and supports_ranges(response)
+                    and not encoded
+                )
+                
+                validator = get_validator(response)
+                resumable = supports_ranges(response) and not encoded
+                
+                # Digests only describe what we store when the body isn't content-encoded
+                server_digests = {} if encoded else get_server_digests(response.headers)
+                hasher = StreamHasher(filepath)
+                
+                # Pipelined upload: hand every chunk that reaches the disk to the uploader
+                on_written = None
+                if stream and total_size and not encoded and stream.begin(filepath, total_size):
+                    on_written = stream.written
+                
+                if segmented:
+                    # The probe response already carries the first block - no extra request
+                    await self._download_segmented(
+                        session, final_url, filepath, total_size, tracker, validator, on_written, hasher,
+                        response=response
+                    )
+                else:
+                    end = total_size - 1 if total_size and not encoded else None
+                    writer = DiskWriter(filepath, on_written=on_written, hasher=hasher)
+                    try:
+                        await self._stream_range(
+                            session, final_url, writer, 0, end, tracker,
+                            validator=validator, resumable=resumable, response=response
+                        )
+                    finally:
+                        await writer.close()
+            
+            hashes = hasher.hexdigests()
+            mismatch = verify_checksums(hashes, server_digests)
+            if mismatch:
+                self._remove(filepath)
+                return None, mismatch
+            
+            self.file_hashes[filepath] = hashes
+            return filepath, None
+                
+        except asyncio.CancelledError:
+            # Cancelled by the user - the partial file goes right away
+            if hasher:
+                hasher.close()
+            if filepath:
+                self._remove(filepath)
+            raise
+        except DownloadError as e:
+            return None, str(e)
         except asyncio.TimeoutError:
             return None, "Download timeout - server too slow"
         except aiohttp.ClientError as e:
@@ -96,62 +734,273 @@ class Downloader:
         except Exception as e:
             return None, f"Download error: {str(e)}"
 
-    async def download_ytdlp(self, url, progress_callback=None):
-        """Download using yt-dlp with BEST quality - ORIGINAL file + TikTok support"""
+    async def _download_segmented(self, session, url, filepath, total_size, tracker,
+                                  validator=None, on_written=None, hasher=None, response=None):
+        """Fetch byte ranges concurrently into a preallocated file.
+        
+        The file is cut into SEGMENT_MIN_SIZE blocks handed out in ascending order to
+        DOWNLOAD_CONNECTIONS workers, so completed data never runs far ahead of the
+        hash frontier and pipelined uploads get parts early. An open response from
+        offset 0 (the probe) is read for the first block instead of requesting it again.
+        """
+        connections = max(1, min(Config.DOWNLOAD_CONNECTIONS, total_size // Config.SEGMENT_MIN_SIZE))
+        blocks = iter([
+            (start, min(start + Config.SEGMENT_MIN_SIZE, total_size) - 1)
+            for start in range(0, total_size, Config.SEGMENT_MIN_SIZE)
+        ])
+        
+        # Preallocate so every block can be written at its own offset
+        writer = DiskWriter(filepath, size=total_size, on_written=on_written, hasher=hasher)
+        
+        async def worker(first_response=None):
+            for start, end in blocks:
+                await self._stream_range(
+                    session, url, writer, start, end, tracker, validator=validator, response=first_response
+                )
+                first_response = None
+        
+        # Tasks start in creation order, so the first one takes block 0 along with the response
+        tasks = [asyncio.create_task(worker(response if i == 0 else None)) for i in range(connections)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await writer.close()
+
+    async def _stream_range(self, session, url, writer, start, end, tracker,
+                            validator=None, resumable=True, response=None):
+        """Write bytes start..end (None = until EOF) of url through writer at their offset.
+        
+        Mid-stream failures reconnect with Range: bytes=<written>- and If-Range, backing off
+        exponentially. An already-open response may be passed in for the first attempt.
+        """
+        offset = start
+        attempt = 0
+        
+        # Active readers share the buffer budget - more readers, smaller chunks
+        buffer_budget.readers += 1
+        try:
+            while True:
+                received = 0
+                try:
+                    if response is None:
+                        headers = {
+                            'Range': f"bytes={offset}-{'' if end is None else end}",
+                            'Accept-Encoding': 'identity'
+                        }
+                        if validator:
+                            headers['If-Range'] = validator
+                        response = await session.get(url, headers=headers)
+                        
+                        # If-Range answers with a full 200 body when the file changed underneath us
+                        if response.status != 206:
+                            response.release()
+                            if response.status == 200 and offset > 0:
+                                raise DownloadError("Remote file changed during download")
+                            raise DownloadError(f"Range request not honoured (HTTP {response.status})")
+                        resumed_validator = get_validator(response)
+                        if validator and resumed_validator and resumed_validator != validator:
+                            response.release()
+                            raise DownloadError("Remote file changed during download")
+                    
+                    async with response:
+                        while end is None or offset <= end:
+                            chunk = await self._read_chunk(response, None if end is None else end + 1 - offset)
+                            if not chunk:
+                                break
+                            try:
+                                await bandwidth.consume(tracker.user_id, len(chunk))
+                                await writer.write(offset, chunk)
+                            except BaseException:
+                                # Never reached the writer - give its budget back here
+                                buffer_budget.release(len(chunk))
+                                raise
+                            offset += len(chunk)
+                            received += len(chunk)
+                            await tracker.advance(len(chunk))
+                    
+                    if end is not None and offset <= end:
+                        raise aiohttp.ClientPayloadError(f"Connection closed at byte {offset} of {end + 1}")
+                    return offset
+                    
+                except RESUMABLE_ERRORS:
+                    response = None
+                    if not resumable:
+                        raise
+                    # Only consecutive failures without progress count towards the retry limit
+                    attempt = 1 if received else attempt + 1
+                    if attempt > Config.DOWNLOAD_RETRIES:
+                        raise
+                    delay = min(Config.RETRY_MAX_DELAY, 2 ** (attempt - 1))
+                    print(f"Resuming {url} at byte {offset} in {delay}s (attempt {attempt})")
+                    await asyncio.sleep(delay)
+        finally:
+            buffer_budget.readers -= 1
+
+    async def _read_chunk(self, response, remaining=None):
+        """Read the next chunk within the global buffer budget - the caller owns its bytes"""
+        size = buffer_budget.chunk_size()
+        if remaining is not None:
+            size = min(size, remaining)
+        await buffer_budget.acquire(size)
         try:
-            ydl_opts = {
-                'outtmpl': os.path.join(self.download_dir, '%(title)s.%(ext)s'),
-                'format': 'bestvideo+bestaudio/best',
-                'merge_output_format': 'mp4',
-                'quiet': True,
-                'no_warnings': True,
-                'writethumbnail': False,
-                'no_post_overwrites': True,
-                'concurrent_fragment_downloads': 5,
-                'buffer_size': 16384,
-                'http_chunk_size': 10485760,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                    'Accept-Language': 'en-us,en;q=0.5',
-                    'Sec-Fetch-Mode': 'navigate',
-                    'Referer': 'https://www.tiktok.com/'
-                },
-                'extractor_args': {
-                    'tiktok': {
-                        'api_hostname': 'api22-normal-c-useast2a.tiktokv.com',
-                        'app_version': '34.1.2',
-                        'manifest_app_version': '341'
-                    }
-                },
-                'retries': 15,
-                'fragment_retries': 15,
-                'skip_unavailable_fragments': True,
-                'keepvideo': False,
-                'socket_timeout': 30,
-                'source_address': '0.0.0.0',
-                'postprocessor_args': {
-                    'ffmpeg': ['-threads', '4']
+            chunk = await response.content.read(size)
+        except BaseException:
+            buffer_budget.release(size)
+            raise
+        buffer_budget.release(size - len(chunk))
+        return chunk
+
+    def ytdlp_options(self, format_spec=None):
+        """YoutubeDL options for our jobs - BEST quality unless a format was picked to fit the limit"""
+        return {
+            'outtmpl': os.path.join(self.download_dir, '%(title)s.%(ext)s'),
+            'format': format_spec or 'bestvideo+bestaudio/best',
+            'merge_output_format': 'mp4',
+            'quiet': True,
+            'no_warnings': True,
+            'writethumbnail': False,
+            'no_post_overwrites': True,
+            'concurrent_fragment_downloads': 5,
+            'buffer_size': 16384,
+            'http_chunk_size': 10485760,
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'en-us,en;q=0.5',
+                'Sec-Fetch-Mode': 'navigate',
+                'Referer': 'https://www.tiktok.com/'
+            },
+            'extractor_args': {
+                'tiktok': {
+                    'api_hostname': 'api22-normal-c-useast2a.tiktokv.com',
+                    'app_version': '34.1.2',
+                    'manifest_app_version': '341'
                 }
+            },
+            'retries': 15,
+            'fragment_retries': 15,
+            'skip_unavailable_fragments': True,
+            'keepvideo': False,
+            'socket_timeout': 30,
+            'source_address': '0.0.0.0',
+            'postprocessor_args': {
+                'ffmpeg': ['-threads', '4']
             }
+        }
+
+    async def extract_ytdlp_info(self, url):
+        """Metadata-only extraction in a worker, cached per normalized URL.
+        
+        Playlist entries are left flat (URL and title) - a video is extracted as usual.
+        """
+        key = normalize_url(url)
+        info = self.ytdlp_info_cache.get(key)
+        if info is None:
+            info = await ytdlp_pool.extract(url, dict(self.ytdlp_options(), extract_flat='in_playlist'))
+            self.ytdlp_info_cache.set(key, info)
+        return info
+
+    async def get_playlist(self, url):
+        """{'title', 'entries': [{'url', 'title'}]} for a playlist/channel link, None for a single video.
+        
+        Shares the cached extraction with download_ytdlp, so checking a video costs nothing extra.
+        """
+        try:
+            info = await self.extract_ytdlp_info(url)
+        except Exception as e:
+            # Not our problem here - the download reports it
+            print(f"Playlist check failed: {e}")
+            return None
+        
+        if info.get('_type') not in ('playlist', 'multi_video'):
+            return None
+        
+        entries = []
+        for entry in info.get('entries') or []:
+            entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+            if entry_url and entry_url.startswith(('http://', 'https://')):
+                entries.append({'url': entry_url, 'title': entry.get('title') or entry_url})
+        if not entries:
+            return None
+        return {'title': info.get('title') or 'Playlist', 'entries': entries[:Config.PLAYLIST_MAX_ITEMS]}
+
+    async def download_ytdlp(self, url, progress_callback=None, user_id=None):
+        """Download using yt-dlp with BEST quality - ORIGINAL file + TikTok support"""
+        try:
+            # Metadata first (cached) - pick a format that fits before downloading anything
+            if progress_callback:
+                await progress_callback(0, 100, "Finding video formats...")
+            info = await self.extract_ytdlp_info(url)
+            if info.get('_type') in ('playlist', 'multi_video'):
+                return None, "Playlists are downloaded item by item - send the playlist link itself"
+            format_spec, size = select_ytdlp_format(info, Config.MAX_FILE_SIZE)
+            if size and size > Config.MAX_FILE_SIZE:
+                return None, f"Smallest available format (~{format_bytes(size)}) exceeds 4GB limit"
             
-            loop = asyncio.get_event_loop()
+            error = await self.reserve_space(self.job_key(url), size or 0, progress_callback)
+            if error:
+                return None, error
             
-            def download():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    filename = ydl.prepare_filename(info)
-                    
-                    base = os.path.splitext(filename)[0]
-                    possible_files = [f"{base}.mp4", f"{base}.mkv", f"{base}.webm", filename]
-                    
-                    for pfile in possible_files:
-                        if os.path.exists(pfile):
-                            return pfile, info.get('title', 'Video')
-                    
-                    return filename, info.get('title', 'Video')
+            ydl_opts = self.ytdlp_options(format_spec)
+            
+            # Worker hooks arrive here on the event loop: feed the UI (coalesced) and pace the
+            # worker's reads - the returned delay is slept off inside its progress hook
+            received = {}
+            totals = {}
+            touched = set()  # Every file name the worker reported - cleaned up if it's killed
+            ui = ProgressCoalescer(progress_callback)
+            
+            def on_worker_progress(d):
+                done = sum(received.values())
+                total = max(size or 0, sum(totals.values()), done)
+                
+                if d.get('phase') == 'postprocess':
+                    if d.get('status') == 'started':
+                        name = d.get('postprocessor') or ''
+                        label = "Merging formats..." if 'Merger' in name else f"Processing ({name})..."
+                        ui.update(total, total, label)
+                    return 0
+                
+                touched.update(name for name in (d.get('filename'), d.get('tmpfilename')) if name)
+                # 'finished' hooks carry no tmpfilename - key by the final name so a file counts once
+                key = d.get('filename') or d.get('tmpfilename')
+                current = d.get('downloaded_bytes') or 0
+                delta = current - received.get(key, 0)
+                received[key] = current
+                totals[key] = d.get('total_bytes') or d.get('total_bytes_estimate') or totals.get(key, 0)
+                if d.get('status') != 'downloading':
+                    return 0
+                
+                done = sum(received.values())
+                total = max(size or 0, sum(totals.values()), done)
+                speed = d.get('speed')
+                status = "Downloading video"
+                if d.get('fragment_count'):
+                    status += f" | fragment {d.get('fragment_index') or 0}/{d['fragment_count']}"
+                ui.update(
+                    done, total, status,
+                    speed=speed, eta=(total - done) / speed if speed else None
+                )
+                return bandwidth.reserve(user_id, delta) if delta > 0 else 0
             
-            filepath, title = await loop.run_in_executor(None, download)
+            try:
+                filename, title = await ytdlp_pool.run(url, ydl_opts, on_worker_progress, info=info)
+            except (asyncio.CancelledError, WorkerError):
+                # The pool killed the worker (cancelled or stalled) mid-write - drop what it left behind
+                for partial in ytdlp_partials(touched):
+                    if os.path.exists(partial):
+                        self._remove(partial)
+                raise
+            finally:
+                await ui.close()
+            
+            # The merger may have changed the extension
+            base = os.path.splitext(filename)[0]
+            possible_files = [f"{base}.mp4", f"{base}.mkv", f"{base}.webm", filename]
+            filepath = next((pfile for pfile in possible_files if os.path.exists(pfile)), filename)
             
             if os.path.exists(filepath):
                 return filepath, None
@@ -159,30 +1008,43 @@ class Downloader:
                 return None, "Failed to download video - file not found after download"
                 
         except yt_dlp.utils.DownloadError as e:
+            # Format URLs in the cached info may have expired - extract afresh next time
+            self.ytdlp_info_cache.pop(normalize_url(url))
             return None, f"yt-dlp download error: {str(e)}"
+        except WorkerError as e:
+            self.ytdlp_info_cache.pop(normalize_url(url))
+            return None, f"yt-dlp worker error: {str(e)}"
         except Exception as e:
             return None, f"Download error: {str(e)}"
 
-    async def download_torrent(self, magnet_or_file, progress_callback=None):
-        """Download torrent using libtorrent with optimized and corrected settings"""
-        ses = None
+    async def download_torrent(self, magnet_or_file, progress_callback=None, user_id=None, stream=None,
+                               select_files=None, file_done=None):
+        """Download torrent using libtorrent with optimized and corrected settings.
+        
+        select_files(files) is awaited once the metadata of a multi-file torrent is known,
+        with torrent_files() of it; it returns (chosen indices, sequential) or None to give up.
+        file_done(path) is awaited for every chosen file as soon as it is complete.
+        """
         handle = None
+        hasher = None
+        cancelled = False
+        key = self.job_key(magnet_or_file)
+        info_hash = key[5:] if key.startswith('btih:') else None
         try:
-            # 1. Setup Session
-            ses = lt.session({'listen_interfaces': '0.0.0.0:6881'})
-            ses.add_dht_router('router.bittorrent.com', 6881)
-            ses.add_dht_router('router.utorrent.com', 6881)
-            
-            settings = {
-                'connections_limit': 400,
-                'alert_mask': lt.alert.category_t.error_notification | lt.alert.category_t.storage_notification | lt.alert.category_t.status_notification
-            }
-            ses.apply_settings(settings)
-
-            # 2. Setup Add Parameters based on input type (FIXED API MISMATCH)
-            if magnet_or_file.startswith('magnet:'):
+            # 1. Setup Add Parameters - resume data from before a restart skips the
+            # metadata fetch and the full piece recheck
+            p = torrent_session.resume_params(info_hash) if info_hash else None
+            resumed = p is not None
+            if resumed:
+                print(f"Resuming torrent {info_hash}")
+            elif magnet_or_file.startswith('magnet:'):
                 # FIX: Call parse_magnet_uri with ONE argument to get the new params object
                 p = lt.parse_magnet_uri(magnet_or_file) 
+                # Metadata cached by an earlier download - no waiting for peers to send it
+                cached = torrent_session.cached_metadata(info_hash) if info_hash else None
+                if cached is not None:
+                    print(f"Torrent metadata from cache: {info_hash}")
+                    p.ti = cached
             else:
                 # It's a torrent file path
                 if not os.path.exists(magnet_or_file):
@@ -193,109 +1055,450 @@ class Downloader:
             # Apply common settings (save_path, storage_mode, flags)
             p.save_path = self.torrent_dir
             p.storage_mode = lt.storage_mode_t.storage_mode_sparse
-            p.flags = lt.torrent_flags.auto_managed 
+            # A resumed torrent keeps its sequential mode (file choices are part of the resume data)
+            set_torrent_flags(p)
+            # Metadata known up front (.torrent file, metadata cache, resume data): add it paused
+            # and outside the queue, or every file starts downloading while the user chooses
+            if p.ti is not None:
+                p.flags |= lt.torrent_flags.paused
+                p.flags &= ~lt.torrent_flags.auto_managed
 
-            # 3. Add Torrent
-            handle = ses.add_torrent(p)
+            # 2. Add Torrent to the shared session - its alert dispatcher reports on it from now on.
+            # The owner record lets a restarted bot pick the job up again (the .torrent file may be gone by then)
+            owner = None
+            if info_hash:
+                source = magnet_or_file if magnet_or_file.startswith('magnet:') else f"magnet:?xt=urn:btih:{info_hash}"
+                owner = {'source': source, 'user_id': user_id}
+            handle, watch = torrent_session.add(p, owner)
+            self.torrent_handles[key] = handle
             
-            # 4. Wait for Metadata and Download Loop
+            # 3. Wait for Metadata and Download Loop
             metadata_timeout = 180  # 3 minutes for metadata/connection
             download_timeout = 7200 # 2 hours overall download timeout
             start_time = time.time()
             last_progress = -1
+            last_total_download = 0
+            rate_limit = None
+            info = None
+            wanted_files = None
+            reported_files = set()
+            done_pieces = None
+            streaming = False
+            space_reserved = False
             
-            while not handle.is_seed():
+            while not watch.finished:
                 # Check overall timeout
                 if time.time() - start_time > download_timeout:
                     return None, "Torrent download timed out after 2 hours."
                 
-                s = handle.status()
-
-                # --- Alert Processing ---
-                alerts = ses.pop_alerts()
-                for alert in alerts:
-                    # Check for critical errors
-                    if type(alert) == lt.torrent_error_alert:
-                        return None, f"Torrent error: {alert.msg}"
-                    # Check for metadata errors/timeouts
-                    if type(alert) == lt.metadata_failed_alert:
-                        return None, "Failed to fetch metadata (no peers/dead torrent)"
+                # --- Errors (routed here by the alert dispatcher) ---
+                if watch.error:
+                    return None, watch.error
+                
+                # Latest status from state_update_alert - no blocking status() call
+                s = watch.status
+                
+                # --- Bandwidth Share ---
+                # libtorrent enforces the limit itself; report what it used to the shared scheduler
+                share = bandwidth.share(user_id)
+                if share != rate_limit:
+                    rate_limit = share
+                    handle.set_download_limit(share or -1)
+                if s is not None:
+                    bandwidth.charge(user_id, s.total_download - last_total_download)
+                    last_total_download = s.total_download
                 
                 # --- Progress Reporting ---
-                if not handle.has_metadata():
+                if s is None or not s.has_metadata:
                     # Metadata phase
                     elapsed = time.time() - start_time
                     if elapsed > metadata_timeout:
                         return None, "Timeout waiting for torrent metadata (3 min)"
 
                     # Update status message with connected peers
-                    status_msg = f"Connecting... ({s.num_peers} peers, {s.num_incomplete} seeds)"
-                    if progress_callback:
+                    if s is not None and progress_callback:
+                        status_msg = f"Connecting... ({s.num_peers} peers, {s.num_incomplete} seeds)"
                         await progress_callback(0, 100, status_msg)
                 
                 else:
                     # Download phase
-                    info = handle.get_torrent_info()
-                    total_size = info.total_size()
+                    if info is None:
+                        info = handle.torrent_file()
+                        # Writing the .torrent and pruning the cache are disk work - off the loop
+                        await asyncio.get_running_loop().run_in_executor(None, torrent_session.store_metadata, info)
                     
-                    if total_size > Config.MAX_FILE_SIZE:
-                        return None, f"Torrent size ({format_bytes(total_size)}) exceeds limit."
+                    # Size is known now - hold the torrent paused until the files are chosen
+                    # and their space is reserved (torrents added with metadata are paused already)
+                    if not space_reserved:
+                        handle.unset_flags(lt.torrent_flags.auto_managed)
+                        handle.pause()
+                        
+                        # Multi-file torrents: download only what the requester picks
+                        # (a resumed torrent already carries its choice)
+                        files = torrent_files(info)
+                        if select_files and len(files) > 1 and not resumed:
+                            selection = await select_files(files)
+                            if selection is None:
+                                return None, "No files selected"
+                            chosen, sequential = selection
+                            handle.prioritize_files([4 if i in chosen else 0 for i in range(info.num_files())])
+                            if sequential:
+                                handle.set_flags(lt.torrent_flags.sequential_download)
+                            wanted_files = [f for f in files if f['index'] in chosen]
+                        else:
+                            priorities = handle.get_file_priorities()
+                            wanted_files = [f for f in files if priorities[f['index']] > 0]
+                        
+                        total_size = sum(f['size'] for f in wanted_files)
+                        if total_size > Config.MAX_FILE_SIZE:
+                            hint = " - choose fewer files" if len(files) > 1 else ""
+                            return None, f"Torrent size ({format_bytes(total_size)}) exceeds limit{hint}."
+                        
+                        # A resumed torrent only needs room for what it doesn't have yet
+                        error = await self.reserve_space(key, max(0, total_size - s.total_done), progress_callback)
+                        if error:
+                            return None, error
+                        handle.resume()
+                        handle.set_flags(lt.torrent_flags.auto_managed)
+                        space_reserved = True
+                    
+                    # Single-file torrents are hashed piece by piece as they verify, and
+                    # pipelined uploads fetch pieces in order and send each verified piece
+                    if done_pieces is None and info.num_files() == 1:
+                        path = os.path.join(self.torrent_dir, info.files().file_path(0))
+                        done_pieces = set()
+                        hasher = StreamHasher(path)
+                        if stream and stream.begin(path, total_size):
+                            handle.set_flags(lt.torrent_flags.sequential_download)
+                            streaming = True
+                    
+                    # Verified pieces come from piece_finished_alert
+                    pieces = watch.take_pieces()
+                    if done_pieces is not None:
+                        new_pieces = [piece for piece in pieces if piece not in done_pieces]
+                        await self._account_pieces(info, new_pieces, done_pieces, hasher, stream if streaming else None)
+                    
+                    # Chosen files that completed (file_completed_alert) can go out before the rest
+                    await self._report_files(watch.take_files(), wanted_files, reported_files, file_done)
                     
-                    progress = s.progress * 100
+                    # Only the chosen files count
+                    progress = s.total_wanted_done / s.total_wanted * 100 if s.total_wanted else 0
                     download_rate = s.download_rate / 1024 / 1024 # MB/s
                     
                     if progress_callback and abs(progress - last_progress) >= 1:
                         last_progress = progress
                         status_msg = f"Torrenting | ↓ {download_rate:.1f} MB/s | {s.num_peers} peers | {progress:.1f}%"
-                        await progress_callback(int(s.total_done), total_size, status_msg)
+                        await progress_callback(int(s.total_wanted_done), int(s.total_wanted), status_msg)
 
-                # Wait for 1 second before the next loop iteration
-                await asyncio.sleep(1)
+                # Sleep until the dispatcher has news - a quiet torrent still wakes up for the timeouts
+                await watch.wait(5)
 
-            # 5. Finalize (after seeding)
-            info = handle.get_torrent_info()
+            # 4. Finalize (after seeding)
+            info = info or handle.torrent_file()
             name = info.name()
+            
+            # Account pieces that completed after the last poll
+            if done_pieces is not None:
+                new_pieces = [piece for piece in range(info.num_pieces()) if piece not in done_pieces]
+                await self._account_pieces(info, new_pieces, done_pieces, hasher, stream if streaming else None)
+
+            files = torrent_files(info)
+            if wanted_files is None:
+                priorities = handle.get_file_priorities()
+                wanted_files = [f for f in files if priorities[f['index']] > 0]
+            await self._report_files(
+                [f['index'] for f in wanted_files], wanted_files, reported_files, file_done
+            )
+            
+            # Files left out only hold the edges of shared pieces - drop them
+            wanted = {f['index'] for f in wanted_files}
+            for f in files:
+                if f['index'] not in wanted:
+                    self._remove(os.path.join(self.torrent_dir, f['path']))
 
-            # Determine final file path
+            # Determine final file path - a single chosen file is returned by itself
             if info.num_files() == 1:
                 filepath = os.path.join(self.torrent_dir, info.files().file_path(0))
+            elif len(wanted_files) == 1:
+                filepath = os.path.join(self.torrent_dir, wanted_files[0]['path'])
             else:
                 filepath = os.path.join(self.torrent_dir, name)
             
+            if hasher:
+                self.file_hashes[filepath] = hasher.hexdigests()
             return filepath, None
             
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
         except Exception as e:
             return None, f"Torrent error: {str(e)}"
         finally:
-            # Clean up the handle and session
-            if ses and handle and handle.is_valid():
-                ses.remove_torrent(handle)
+            if hasher:
+                hasher.close()
+            # Take the torrent out of the shared session - a cancelled one takes its partial data with it
+            self.torrent_handles.pop(key, None)
+            if handle and handle.is_valid():
+                torrent_session.remove(handle, delete_files=cancelled)
+
+    async def _report_files(self, indices, wanted_files, reported_files, file_done):
+        """Await file_done(path) once for each chosen file among the completed indices"""
+        if not file_done or wanted_files is None:
+            return
+        paths = {f['index']: f['path'] for f in wanted_files}
+        for index in indices:
+            if index in paths and index not in reported_files:
+                reported_files.add(index)
+                await file_done(os.path.join(self.torrent_dir, paths[index]))
+
+    async def _account_pieces(self, info, pieces, done_pieces, hasher, stream=None):
+        """Hand newly verified torrent pieces to the streaming upload and the hasher"""
+        if not pieces:
+            return
+        done_pieces.update(pieces)
+        ranges = [(piece * info.piece_length(), info.piece_size(piece)) for piece in pieces]
+        if stream:
+            for offset, length in ranges:
+                stream.written(offset, length)
+        
+        # Sequential pieces are read back from the page cache; out-of-order ones wait in the hasher
+        def feed():
+            for offset, length in ranges:
+                hasher.update(offset, length)
+        await asyncio.get_running_loop().run_in_executor(None, feed)
 
-    async def download(self, url_or_file, filename=None, progress_callback=None):
-        """Main download function - auto-detects type"""
+    async def download(self, url_or_file, filename=None, progress_callback=None, user_id=None, stream=None, checksum=None,
+                       cancel_token=None, select_files=None, file_done=None):
+        """Main download function - auto-detects type.
+        
+        Identical concurrent requests (same normalized URL or infohash) attach to the
+        running job: they share its progress and its finished file. Every successful
+        caller holds one reference to the file and must release it with cleanup().
+        
+        stream (an uploader.StreamingUpload) is fed with the bytes as they land on disk
+        when the engine supports it; only the job's first requester can stream.
+        
+        checksum ({'sha256': hex} and/or {'md5': hex}) is verified for this caller only;
+        on mismatch its file reference is released and an error returned.
+        
+        cancel_token (helpers.CancelToken) detaches this caller with a "cancelled" error;
+        when nobody else waits for the job, its transfer is stopped and the partial data
+        and disk reservation are freed.
+        
+        select_files and file_done are torrent hooks (see download_torrent); like stream,
+        only the job's first requester gets them.
+        """
         
         if not url_or_file:
             return None, "No URL or file provided"
         
-        if isinstance(url_or_file, str) and (url_or_file.startswith('magnet:') or url_or_file.endswith('.torrent')):
-            return await self.download_torrent(url_or_file, progress_callback)
+        key = self.job_key(url_or_file)
+        job = self.jobs.get(key)
+        
+        # Finished and still held by someone - hand out the same file instantly
+        if job and job['future'].done():
+            job['refs'] += 1
+            return await self._verify_result(job['future'].result(), checksum)
+        
+        if job is None:
+            job = {
+                'key': key,
+                'future': asyncio.get_running_loop().create_future(),
+                'callbacks': [],
+                'waiters': 0,
+                'refs': 0,
+                'filepath': None
+            }
+            self.jobs[key] = job
+            job['task'] = asyncio.create_task(
+                self._run_job(job, url_or_file, filename, user_id, stream, select_files, file_done)
+            )
+        else:
+            print(f"Attached to in-flight download: {key}")
+        
+        if progress_callback:
+            job['callbacks'].append(progress_callback)
+        job['waiters'] += 1
+        
+        cancelled = asyncio.get_running_loop().create_future()
+        remove_callback = None
+        if cancel_token:
+            remove_callback = cancel_token.add_callback(
+                lambda: cancelled.done() or cancelled.set_result(None)
+            )
+        try:
+            await asyncio.wait([job['future'], cancelled], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            self._detach(job)
+            raise
+        finally:
+            if remove_callback:
+                remove_callback()
+            if progress_callback in job['callbacks']:
+                job['callbacks'].remove(progress_callback)
+        
+        if not job['future'].done():
+            self._detach(job)
+            return None, "Download cancelled"
         
-        video_domains = [
-            'youtube.com', 'youtu.be', 'instagram.com', 'facebook.com', 
-            'twitter.com', 'tiktok.com', 'vimeo.com', 'dailymotion.com',
-            'vt.tiktok.com', 'vm.tiktok.com', 'x.com', 'twitch.tv',
-            'reddit.com', 'streamable.com', 'imgur.com'
-        ]
+        return await self._verify_result(job['future'].result(), checksum)
+
+    def _detach(self, job):
+        """A waiter left before the job finished - stop the transfer if it was the last one"""
+        job['waiters'] -= 1
+        if job['waiters'] <= 0 and not job['future'].done():
+            print(f"Cancelling download: {job['key']}")
+            job['task'].cancel()
+
+    async def _verify_result(self, result, checksum):
+        """Check a finished download against the caller's expected checksum"""
+        filepath, error = result
+        if not checksum or error or not filepath:
+            return result
+        
+        hashes = await self.get_hashes(filepath)
+        mismatch = verify_checksums(hashes, checksum) if hashes else "Checksums can only be verified for single files"
+        if mismatch:
+            self.cleanup(filepath)
+            return None, mismatch
+        return result
+
+    async def get_hashes(self, filepath):
+        """SHA-256/MD5 of a finished download - hashed while downloading where the engine allows"""
+        hashes = self.file_hashes.get(filepath)
+        if hashes is None and os.path.isfile(filepath):
+            # yt-dlp output and multi-file torrents were not hashed in flight
+            hashes = await asyncio.get_running_loop().run_in_executor(None, hash_file, filepath)
+            self.file_hashes[filepath] = hashes
+        return hashes
+
+    def job_key(self, url_or_file):
+        """Singleflight key - infohash for torrents, normalized URL otherwise"""
+        if url_or_file.startswith('magnet:'):
+            infohash = get_magnet_infohash(url_or_file)
+            if infohash:
+                return f"btih:{infohash}"
+        elif url_or_file.endswith('.torrent') and os.path.exists(url_or_file):
+            try:
+                return f"btih:{str(lt.torrent_info(url_or_file).info_hash()).lower()}"
+            except Exception:
+                return url_or_file
+        return normalize_url(url_or_file)
+
+    async def _run_job(self, job, url_or_file, filename, user_id, stream=None, select_files=None, file_done=None):
+        """Run one download for every attached requester"""
+        async def fan_out(current, total, status="Downloading", **kwargs):
+            await asyncio.gather(
+                *(callback(current, total, status, **kwargs) for callback in list(job['callbacks'])),
+                return_exceptions=True
+            )
         
-        is_video_url = any(domain in url_or_file.lower() for domain in video_domains)
+        bandwidth.join(user_id)
+        try:
+            filepath, error = await self._download(url_or_file, filename, fan_out, user_id, stream, select_files, file_done)
+        except asyncio.CancelledError:
+            # Every waiter left - the engine already dropped its partial data
+            filepath, error = None, "Download cancelled"
+        except Exception as e:
+            filepath, error = None, f"Download error: {str(e)}"
+        finally:
+            bandwidth.leave(user_id)
         
-        if is_video_url:
-            return await self.download_ytdlp(url_or_file, progress_callback)
+        if error or not filepath:
+            self.jobs.pop(job['key'], None)
+            disk_space.release(job['key'])
         else:
-            return await self.download_file(url_or_file, filename, progress_callback)
+            disk_space.settle(job['key'])
+            # One reference per requester still waiting for the result
+            job['filepath'] = filepath
+            job['refs'] = job['waiters']
+            self.file_jobs[filepath] = job
+            if job['refs'] <= 0:
+                self._forget_job(job)
+                self._remove(filepath)
+        
+        job['future'].set_result((filepath, error))
+
+    def _forget_job(self, job):
+        self.jobs.pop(job['key'], None)
+        self.file_jobs.pop(job['filepath'], None)
+        disk_space.release(job['key'])
+
+    async def reserve_space(self, key, size, progress_callback=None):
+        """Admission control - hold size bytes of disk for job key, queueing while it doesn't fit"""
+        async def on_wait(needed, available):
+            if progress_callback:
+                await progress_callback(0, needed, f"Waiting for disk space ({format_bytes(available)} free)")
+        
+        return await disk_space.reserve(key, size, on_wait)
+
+    async def _download(self, url_or_file, filename, progress_callback, user_id, stream=None, select_files=None, file_done=None):
+        """Route to the right engine - runs inside the user's bandwidth share"""
+        if isinstance(url_or_file, str) and (url_or_file.startswith('magnet:') or url_or_file.endswith('.torrent')):
+            return await self.download_torrent(url_or_file, progress_callback, user_id, stream, select_files, file_done)
+        
+        engine = router.route(url_or_file)
+        if engine == 'ytdlp':
+            return await self.download_ytdlp(url_or_file, progress_callback, user_id)
+        
+        # Preflight (usually a cache hit from the UI) - reject oversized files before any transfer
+        info = await self.preflight(url_or_file)
+        if info:
+            if info['size'] > Config.MAX_FILE_SIZE:
+                return None, f"File size ({format_bytes(info['size'])}) exceeds 4GB limit"
+            
+            # A web page on a host no extractor claims - let yt-dlp's generic extractor find the media
+            if info['content_type'] == 'text/html' and engine is None:
+                return await self.download_ytdlp(url_or_file, progress_callback, user_id)
+            
+            filename = filename or info['filename']
+        
+        # Size unknown (no preflight) - reserving 0 still enforces the free-space margin
+        error = await self.reserve_space(self.job_key(url_or_file), info['size'] if info else 0, progress_callback)
+        if error:
+            return None, error
+        
+        return await self.download_file(url_or_file, filename, progress_callback, user_id, stream)
     
+    def rename(self, filepath, new_path):
+        """Rename a finished download - files shared with other users are hardlinked instead"""
+        job = self.file_jobs.get(filepath)
+        
+        if job and job['refs'] > 1:
+            if os.path.isdir(filepath):
+                shutil.copytree(filepath, new_path, copy_function=os.link)
+            else:
+                try:
+                    os.link(filepath, new_path)
+                except OSError:
+                    shutil.copy2(filepath, new_path)
+            job['refs'] -= 1
+            if filepath in self.file_hashes:
+                self.file_hashes[new_path] = self.file_hashes[filepath]
+            return new_path
+        
+        os.rename(filepath, new_path)
+        if filepath in self.file_hashes:
+            self.file_hashes[new_path] = self.file_hashes.pop(filepath)
+        if job:
+            # Sole owner - the renamed file is private, later requests start a new job
+            self._forget_job(job)
+        return new_path
+
     def cleanup(self, filepath):
+        """Release one reference to a download - the file is removed after the last consumer"""
+        job = self.file_jobs.get(filepath)
+        if job:
+            job['refs'] -= 1
+            if job['refs'] > 0:
+                return True
+            self._forget_job(job)
+        
+        return self._remove(filepath)
+
+    def _remove(self, filepath):
         """Remove downloaded file or directory"""
+        self.file_hashes.pop(filepath, None)
         try:
             if os.path.isfile(filepath):
                 os.remove(filepath)
@@ -306,4 +1509,5 @@ class Downloader:
             print(f"Cleanup error: {e}")
             return False
 
+buffer_budget = BufferBudget(Config.BUFFER_BUDGET)
 downloader = Downloader()
@@ -1,8 +1,13 @@
+import os
 import time
 import asyncio
 import math
+import base64
+import binascii
+import subprocess
+from collections import OrderedDict
 from typing import Optional
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qs
 
 class Progress:
     """Progress tracker for downloads and uploads with stunning UI - Optimized"""
@@ -14,22 +19,28 @@ class Progress:
         self.last_update = 0
         self.update_interval = 1.5  # Update every 1.5 seconds for better feedback
         self.last_percentage = -1
+        self.last_status = None
         self.last_text = ""  # Cache last message to avoid duplicate edits
         
-    async def progress_callback(self, current, total, status="Downloading"):
-        """Progress callback with beautiful box-style formatting - Optimized"""
+    async def progress_callback(self, current, total, status="Downloading", speed=None, eta=None):
+        """Progress callback with beautiful box-style formatting - Optimized
+        
+        speed (bytes/s) and eta (seconds) override the averages since start when the
+        engine reports live values (yt-dlp).
+        """
         now = time.time()
         
         # Calculate percentage early
         percentage = calculate_percentage(current, total)
         
         # Skip update if:
-        # 1. Too soon since last update AND percentage change is small
+        # 1. Too soon since last update AND percentage change is small AND same phase
         # 2. Avoid hammering API with identical updates
         if (now - self.last_update < self.update_interval and 
-            abs(percentage - self.last_percentage) < 1):
+            abs(percentage - self.last_percentage) < 1 and status == self.last_status):
             return
-            
+        self.last_status = status
+        
         elapsed = now - self.start_time
         
         if current == 0 or elapsed == 0:
@@ -55,9 +66,13 @@ class Progress:
             self.last_percentage = percentage
             
             # Optimized calculations
-            speed = current / elapsed
+            if speed is None:
+                speed = current / elapsed
             speed_mb = speed / (1024 * 1024)
-            eta_seconds = max(0, (total - current) / speed) if speed > 0 else 0
+            if eta is not None:
+                eta_seconds = max(0, eta)
+            else:
+                eta_seconds = max(0, (total - current) / speed) if speed > 0 else 0
             
             # Format data efficiently
             current_mb = current / (1024 * 1024)
@@ -101,6 +116,82 @@ class Progress:
                 # Only print unexpected errors
                 print(f"Progress update error: {e}")
 
+class PlaylistProgress:
+    """One status message with a line per playlist item"""
+    
+    STATES = {
+        'queued': '⏳', 'downloading': '⬇️', 'uploading': '⬆️', 'done': '✅',
+        'cached': '⚡', 'failed': '❌', 'cancelled': '🛑'
+    }
+    MAX_LINES = 20  # Longer playlists only list the items in flight and the failures
+    
+    def __init__(self, client, message, title, titles):
+        self.client = client
+        self.message = message
+        self.title = title
+        self.items = [{'title': t, 'state': 'queued', 'detail': ''} for t in titles]
+        self.last_update = 0
+        self.update_interval = 3  # One message for many items - edit less often than Progress
+        self.last_text = ""
+        
+    def set(self, index, state, detail=""):
+        """Change the state of one item"""
+        self.items[index]['state'] = state
+        self.items[index]['detail'] = detail
+        
+    def item_callback(self, index):
+        """Progress callback (download or pyrogram upload) for one item"""
+        async def callback(current, total, status="Downloading", **kwargs):
+            state = 'uploading' if status == "Uploading" else 'downloading'
+            detail = f"{calculate_percentage(current, total):.0f}%" if current else status
+            self.set(index, state, detail)
+            await self.refresh()
+        return callback
+        
+    def render(self):
+        counts = {state: 0 for state in self.STATES}
+        for item in self.items:
+            counts[item['state']] += 1
+            
+        shown = range(len(self.items))
+        if len(self.items) > self.MAX_LINES:
+            shown = [
+                i for i, item in enumerate(self.items)
+                if item['state'] in ('downloading', 'uploading', 'failed')
+            ][:self.MAX_LINES]
+            
+        lines = [
+            f"{i + 1}. {self.STATES[self.items[i]['state']]} `{truncate_text(self.items[i]['title'], 40)}`"
+            + (f" {truncate_text(self.items[i]['detail'], 60)}" if self.items[i]['detail'] else "")
+            for i in shown
+        ]
+        return (
+            f"📃 **{truncate_text(self.title, 60)}**\n\n"
+            f"✅ **Done:** {counts['done'] + counts['cached']} / {len(self.items)}"
+            f" | ⬇️ {counts['downloading']} | ⬆️ {counts['uploading']}"
+            f" | ⏳ {counts['queued']} | ❌ {counts['failed'] + counts['cancelled']}\n\n"
+            + "\n".join(lines)
+        )
+        
+    async def refresh(self, force=False):
+        """Edit the message - throttled unless force"""
+        now = time.time()
+        if not force and now - self.last_update < self.update_interval:
+            return
+            
+        text = self.render()
+        if text == self.last_text:
+            return
+        self.last_update = now
+        self.last_text = text
+        
+        try:
+            await self.message.edit_text(text, disable_web_page_preview=True)
+        except Exception as e:
+            error_msg = str(e).lower()
+            if not any(x in error_msg for x in ['not modified', 'message to edit not found', 'message is not modified']):
+                print(f"Playlist progress update error: {e}")
+
 def get_status_config(status):
     """Get status configuration - Optimized with dict"""
     status_lower = status.lower()
@@ -291,6 +382,27 @@ def format_duration(seconds):
     
     return f"{hours:02d}:{minutes:02d}:{secs:02d}" if hours > 0 else f"{minutes:02d}:{secs:02d}"
 
+def get_video_metadata(filepath):
+    """Read duration/width/height with ffprobe"""
+    duration = width = height = 0
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries',
+             'format=duration:stream=width,height', '-of',
+             'default=noprint_wrappers=1', filepath],
+            capture_output=True, text=True, timeout=10
+        )
+        for line in result.stdout.split('\n'):
+            if 'duration=' in line:
+                duration = int(float(line.split('=')[1]))
+            elif 'width=' in line:
+                width = int(line.split('=')[1])
+            elif 'height=' in line:
+                height = int(line.split('=')[1])
+    except Exception:
+        pass
+    return duration, width, height
+
 async def run_command(command):
     """Run shell command asynchronously - Optimized with timeout"""
     try:
@@ -355,6 +467,25 @@ def parse_torrent_info(info_dict):
         'pieces': info_dict.get('num_pieces', 0)
     }
 
+def get_magnet_infohash(magnet):
+    """Extract the BTIH infohash from a magnet link as lowercase hex, None if absent"""
+    if not is_magnet(magnet):
+        return None
+    
+    for value in parse_qs(urlparse(magnet.strip()).query).get('xt', []):
+        if not value.lower().startswith('urn:btih:'):
+            continue
+        infohash = value[9:]
+        if len(infohash) == 40:
+            return infohash.lower()
+        if len(infohash) == 32:
+            # Base32 form used by some older clients
+            try:
+                return base64.b32decode(infohash.upper()).hex()
+            except (ValueError, binascii.Error):
+                return None
+    return None
+
 def validate_url(url):
     """Validate if URL is properly formatted - Optimized"""
     if not url or not isinstance(url, str):
@@ -366,6 +497,155 @@ def validate_url(url):
     except Exception:
         return False
 
+def normalize_url(url):
+    """Normalize URL for use as a cache key - lowercases scheme/host, drops default port and fragment"""
+    if not url or not isinstance(url, str):
+        return url
+    
+    try:
+        parts = urlparse(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    
+    netloc = host
+    if port and (scheme, port) not in (('http', 80), ('https', 443)):
+        netloc = f"{host}:{port}"
+    if parts.username:
+        userinfo = parts.username + (f":{parts.password}" if parts.password else '')
+        netloc = f"{userinfo}@{netloc}"
+    
+    return urlunparse((scheme, netloc, parts.path or '/', parts.params, parts.query, ''))
+
+HASH_LENGTHS = {'sha256': 64, 'md5': 32}
+
+def parse_download_request(text):
+    """Split 'url | filename | sha256:<hex>' into (url, filename, checksum).
+
+    Filename and checksum are optional and may come in any order; checksum is a dict
+    like {'sha256': '<hex>'} or None. A malformed checksum raises ValueError.
+    """
+    parts = [part.strip() for part in text.strip().split('|')]
+    url = parts[0]
+    filename = None
+    checksum = None
+
+    for part in parts[1:]:
+        if not part:
+            continue
+        algorithm, _, value = part.partition(':')
+        algorithm = algorithm.lower().replace('-', '')
+        if algorithm in HASH_LENGTHS and value:
+            value = value.strip().lower()
+            if len(value) != HASH_LENGTHS[algorithm] or any(c not in '0123456789abcdef' for c in value):
+                raise ValueError(f"Invalid {algorithm.upper()} checksum")
+            checksum = checksum or {}
+            checksum[algorithm] = value
+        else:
+            filename = part
+
+    return url, filename, checksum
+
+def parse_file_selection(text, count):
+    """Parse a torrent file choice like '1,3,5-7 seq' into (0-based indices, sequential).
+    
+    'all' selects every file; a trailing 'seq' asks for sequential download.
+    Raises ValueError on numbers outside 1..count or unreadable input.
+    """
+    words = text.lower().replace(',', ' ').split()
+    sequential = 'seq' in words
+    words = [word for word in words if word != 'seq']
+    if not words:
+        raise ValueError("No files selected")
+        
+    chosen = set()
+    for word in words:
+        if word == 'all':
+            chosen.update(range(count))
+            continue
+        first, _, last = word.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError(f"Can't read '{word}'")
+        first, last = int(first), int(last or first)
+        if not 1 <= first <= last <= count:
+            raise ValueError(f"Choose numbers from 1 to {count}")
+        chosen.update(range(first - 1, last))
+    return chosen, sequential
+
+class TTLCache:
+    """Small LRU cache whose entries expire after ttl seconds"""
+    
+    def __init__(self, maxsize=256, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        
+    def get(self, key, default=None):
+        """Get a live entry and mark it as recently used"""
+        item = self.data.get(key)
+        if item is None:
+            return default
+        
+        value, expires = item
+        if expires < time.monotonic():
+            del self.data[key]
+            return default
+        
+        self.data.move_to_end(key)
+        return value
+        
+    def set(self, key, value, ttl=None):
+        """Store an entry, evicting the least recently used ones beyond maxsize"""
+        self.data[key] = (value, time.monotonic() + (ttl or self.ttl))
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            
+    def pop(self, key, default=None):
+        """Remove an entry"""
+        item = self.data.pop(key, None)
+        return default if item is None else item[0]
+        
+    def __len__(self):
+        return len(self.data)
+
+class CancelToken:
+    """Cancellation handle for one user's download/upload.
+    
+    cancel() runs every registered callback once; callbacks added after that run
+    immediately. Operations register what stops them (cancel a task, abort a stream).
+    """
+    
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+        
+    def cancel(self):
+        """Stop everything registered - safe to call more than once"""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback error: {e}")
+                
+    def add_callback(self, callback):
+        """Register callback(); returns a function that unregisters it"""
+        if self.cancelled:
+            callback()
+            return lambda: None
+        self.callbacks.append(callback)
+        
+        def remove():
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+        return remove
+
 def get_readable_message(current, total, status="Processing"):
     """Get a readable progress message - Optimized"""
     if total <= 0:
@@ -395,6 +675,16 @@ def estimate_completion_time(current, total, start_time):
     
     return format_time(remaining / rate)
 
+def get_path_size(path):
+    """Size of a file, or of every file under a directory"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
 def get_file_size_mb(size_bytes):
     """Convert bytes to MB - Inline optimized"""
     return size_bytes / (1024 * 1024)
@@ -0,0 +1,187 @@
+import re
+import threading
+from urllib.parse import urlparse
+from yt_dlp.extractor import gen_extractor_classes
+from config import Config
+from helpers import TTLCache
+
+try:
+    import re._parser as sre_parse
+    from re._constants import LITERAL, SUBPATTERN, BRANCH, MAX_REPEAT, MIN_REPEAT, IN, AT
+except ImportError:  # Python < 3.11
+    import sre_parse
+    from sre_constants import LITERAL, SUBPATTERN, BRANCH, MAX_REPEAT, MIN_REPEAT, IN, AT
+
+# Our own routing decisions, checked before the extractor index (host or parent domain -> engine)
+HOST_OVERRIDES = {
+    # Media CDNs serve the file itself - never hand these to an extractor
+    'googlevideo.com': 'http',
+    'cdninstagram.com': 'http',
+    'fbcdn.net': 'http',
+    'video.twimg.com': 'http',
+    'tiktokcdn.com': 'http',
+}
+
+WILDCARD = '\0'
+MAX_VARIANTS = 4096  # Give up on patterns whose host part expands to more strings than this
+
+def _canonical(prefix):
+    """Keep only what matters for the host: from '//' up to the first path character"""
+    start = prefix.find('//')
+    if start < 0:
+        return prefix
+    prefix = prefix[start:]
+    end = re.search(r'[/?#]', prefix[2:])
+    return prefix[:end.start() + 3] if end else prefix
+
+def _host_done(prefix):
+    start = prefix.find('//')
+    return start >= 0 and any(c in prefix[start + 2:] for c in '/?#')
+
+def _expand(items, prefixes):
+    """Enumerate the strings a parsed regex can start with, up to the end of the host.
+    
+    Alternations and optional groups are expanded, anything open-ended becomes WILDCARD.
+    Returns None when the pattern expands to too many variants.
+    """
+    prefixes = list(dict.fromkeys(_canonical(p) for p in prefixes))
+    for op, av in items:
+        if all(_host_done(p) for p in prefixes):
+            break
+            
+        if op is SUBPATTERN:
+            prefixes = _expand(av[-1], prefixes)
+        elif op is BRANCH:
+            branches = [_expand(seq, prefixes) for seq in av[1]]
+            prefixes = None if None in branches else [p for branch in branches for p in branch]
+        elif op in (MAX_REPEAT, MIN_REPEAT):
+            low, high, sub = av
+            if high == 1:
+                expanded = _expand(sub, prefixes)
+                prefixes = None if expanded is None else (prefixes if low == 0 else []) + expanded
+            else:
+                if low >= 1:
+                    prefixes = _expand(sub, prefixes)
+                prefixes = prefixes and [p + WILDCARD for p in prefixes]
+        else:
+            if op is LITERAL:
+                options = [chr(av)]
+            elif op is IN and all(o is LITERAL for o, _ in av):
+                # Character classes like [yY] - case doesn't matter for hosts
+                options = list(dict.fromkeys(chr(a).lower() for _, a in av))
+                if len(options) > 4:
+                    options = [WILDCARD]
+            elif op is AT:
+                options = ['']
+            else:
+                options = [WILDCARD]
+            prefixes = [p + o for p in prefixes for o in options]
+            
+        if prefixes is None or len(prefixes) > MAX_VARIANTS:
+            return None
+    return prefixes
+
+def extract_hosts(pattern):
+    """Hosts an extractor's _VALID_URL can match - 'name.*' for wildcard TLDs"""
+    try:
+        variants = _expand(list(sre_parse.parse(pattern, re.IGNORECASE)), [''])
+    except Exception:
+        return set()
+        
+    hosts = set()
+    for variant in variants or []:
+        start = variant.find('//')
+        if start < 0:
+            continue
+        host = re.split(r'[/?#:]', variant[start + 2:], 1)[0].lower()
+        host = re.sub(f'{WILDCARD}+', WILDCARD, host)
+        if host.endswith('.' + WILDCARD):
+            host = host[:-1] + '*'
+        if WILDCARD in host:
+            # A wildcard subdomain part still leaves a usable suffix: (?:\w+\.)?youtube\.com
+            host = host[host.rfind(WILDCARD) + 1:]
+            if not host.startswith('.'):
+                continue
+            host = host[1:]
+        if '.' in host and not host.startswith(('.', '*')):
+            hosts.add(host)
+    return hosts
+
+class EngineRouter:
+    """Pick the download engine for a URL by its host.
+    
+    The index maps every host named in yt-dlp's extractor URL patterns (plus
+    HOST_OVERRIDES) to its extractors. A lookup walks the host's parent domains, so
+    cost depends on the number of labels, not on the number of extractors; the
+    candidates per host are cached. yt-dlp is chosen only when one of them actually
+    accepts the URL - anything else is left to the preflight content type.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+        self.host_cache = TTLCache(maxsize=Config.ROUTE_CACHE_SIZE, ttl=Config.ROUTE_CACHE_TTL)
+
+    def build_index(self):
+        """Scan yt-dlp's extractors once (about a second) - safe to call from a worker thread"""
+        with self.lock:
+            if self.index is not None:
+                return
+                
+            index = {}
+            for ie in gen_extractor_classes():
+                patterns = getattr(ie, '_VALID_URL', None)
+                if not patterns or ie.ie_key() == 'Generic':
+                    continue
+                if isinstance(patterns, str):
+                    patterns = [patterns]
+                hosts = set()
+                for pattern in patterns:
+                    hosts |= extract_hosts(pattern)
+                for host in hosts:
+                    index.setdefault(host, []).append(ie)
+                    
+            self.index = index
+            print(f"Engine router indexed {len(index)} hosts")
+
+    def route(self, url):
+        """'ytdlp', 'http', or None when only the content type can tell"""
+        try:
+            host = (urlparse(url).hostname or '').lower().rstrip('.')
+        except ValueError:
+            return None
+        if not host:
+            return None
+            
+        override, candidates = self.lookup(host)
+        if override:
+            return override
+        if any(ie.suitable(url) for ie in candidates):
+            return 'ytdlp'
+        return None
+
+    def lookup(self, host):
+        """(override engine, candidate extractors) for host - cached per host"""
+        cached = self.host_cache.get(host)
+        if cached is not None:
+            return cached
+            
+        if self.index is None:
+            self.build_index()
+            
+        override = None
+        candidates = []
+        labels = host.split('.')
+        for i in range(len(labels) - 1):
+            suffix = '.'.join(labels[i:])
+            if override is None:
+                override = HOST_OVERRIDES.get(suffix)
+            candidates.extend(self.index.get(suffix, ()))
+            # Extractors written for any TLD: dailymotion\.[a-z]{2,3}
+            candidates.extend(self.index.get('.'.join(labels[i:-1]) + '.*', ()))
+            
+        result = (override, tuple(dict.fromkeys(candidates)))
+        self.host_cache.set(host, result)
+        return result
+
+router = EngineRouter()
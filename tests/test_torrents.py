@@ -0,0 +1,61 @@
+import os
+import asyncio
+import pytest
+
+lt = pytest.importorskip("libtorrent")
+pytest.importorskip("aiohttp")
+pytest.importorskip("yt_dlp")
+
+from downloader import set_torrent_flags
+from torrents import TorrentSession
+
+
+def make_torrent(tmp_path):
+    """A one-file torrent whose data is already in tmp_path/data"""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    (data_dir / "file.bin").write_bytes(os.urandom(256 * 1024))
+    fs = lt.file_storage()
+    lt.add_files(fs, str(data_dir / "file.bin"))
+    creator = lt.create_torrent(fs)
+    lt.set_piece_hashes(creator, str(data_dir))
+    return lt.torrent_info(lt.bencode(creator.generate())), str(data_dir)
+
+
+def test_added_torrent_status_reaches_watch(tmp_path):
+    info, save_path = make_torrent(tmp_path)
+    session = TorrentSession(str(tmp_path / "state"), str(tmp_path / "resume"), str(tmp_path / "meta"))
+
+    async def run():
+        p = lt.add_torrent_params()
+        p.ti = info
+        p.save_path = save_path
+        set_torrent_flags(p)
+        handle, watch = session.add(p)
+        try:
+            for _ in range(20):
+                if watch.status is not None:
+                    break
+                await watch.wait(0.5)
+            return watch.status
+        finally:
+            session.remove(handle)
+            session.close()
+
+    status = asyncio.run(run())
+    assert status is not None
+    assert status.has_metadata
+
+
+def test_session_state_round_trip(tmp_path, capsys):
+    state_file = tmp_path / "state"
+    session = TorrentSession(str(state_file), str(tmp_path / "resume"), str(tmp_path / "meta"))
+    session.get()
+    session.save_state()
+    session.close()
+
+    assert state_file.exists() and state_file.stat().st_size > 0
+    TorrentSession(str(state_file), str(tmp_path / "resume"), str(tmp_path / "meta"))._load()
+    output = capsys.readouterr().out
+    assert "not saved" not in output
+    assert "ignored" not in output
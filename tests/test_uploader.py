@@ -0,0 +1,44 @@
+import asyncio
+import pytest
+
+pytest.importorskip("pyrogram")
+
+import uploader
+from bandwidth import BandwidthScheduler
+from helpers import PlaylistProgress
+
+
+class FakeClient:
+    def rnd_id(self):
+        return 1
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+def test_upload_parts_reports_speed_to_playlist_progress(tmp_path, monkeypatch):
+    """upload_parts' speed keyword must pass through throttled_progress into PlaylistProgress"""
+    sent = []
+
+    async def save_part(client, file_id, part, total_parts, data, big=True):
+        sent.append(part)
+
+    monkeypatch.setattr(uploader, 'save_part', save_part)
+    path = tmp_path / "item.mp4"
+    path.write_bytes(b"x" * (3 * uploader.PART_SIZE - 10))
+
+    message = FakeMessage()
+    progress = PlaylistProgress(None, message, "Playlist", ["item"])
+    callback = BandwidthScheduler().throttled_progress(1, progress.item_callback(0))
+
+    file = asyncio.run(uploader.upload_parts(FakeClient(), str(path), callback, workers=2))
+
+    assert sorted(sent) == [0, 1, 2]
+    assert file.parts == 3
+    assert progress.items[0]['state'] == 'uploading'
+    assert progress.items[0]['detail'] == "100%"
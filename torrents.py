@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import libtorrent as lt
+from config import Config
+
+DHT_BOOTSTRAP_NODES = 'router.bittorrent.com:6881,router.utorrent.com:6881,dht.transmissionbt.com:6881,dht.libtorrent.org:25401'
+
+SESSION_SETTINGS = {
+    'listen_interfaces': Config.TORRENT_LISTEN,
+    'dht_bootstrap_nodes': DHT_BOOTSTRAP_NODES,
+    'enable_dht': True,
+    'enable_lsd': False,
+    'enable_upnp': False,
+    'enable_natpmp': False,
+    'connections_limit': Config.TORRENT_CONNECTIONS,
+    'connection_speed': 50,  # New outgoing connection attempts per second
+    'unchoke_slots_limit': 16,
+    # Every job is downloaded right away - don't let the queue hold any back
+    'active_downloads': -1,
+    'active_seeds': -1,
+    'active_limit': -1,
+    # Disk: deeper write queue and more I/O threads for many parallel pieces
+    'max_queued_disk_bytes': 64 * 1024 * 1024,
+    'aio_threads': 8,
+    'send_buffer_watermark': 4 * 1024 * 1024,
+    'max_out_request_queue': 1500,
+    'alert_queue_size': 10000,
+    'alert_mask': (
+        lt.alert.category_t.error_notification
+        | lt.alert.category_t.storage_notification
+        | lt.alert.category_t.status_notification
+        | lt.alert.category_t.piece_progress_notification
+        # file_completed_alert (libtorrent 1.2 files it under progress_notification)
+        | getattr(lt.alert.category_t, 'file_progress_notification', lt.alert.category_t.progress_notification)
+    )
+}
+
+METADATA_FAILED = "Failed to fetch metadata (no peers/dead torrent)"
+
+# Keep the metadata in the resume data - a resumed magnet doesn't wait for peers to send it again
+RESUME_FLAGS = getattr(lt.save_resume_flags_t, 'save_info_dict', 0)
+
+class TorrentWatch:
+    """Everything the alert dispatcher learned about one torrent - used on the event loop"""
+
+    def __init__(self):
+        self.status = None  # Latest torrent_status (from state_update_alert)
+        self.finished = False
+        self.error = None
+        self.pieces = []  # Verified pieces not taken yet
+        self.files = []  # Completed file indices not taken yet
+        self.changed = asyncio.Event()
+
+    async def wait(self, timeout):
+        """Sleep until the dispatcher delivers news about this torrent, at most timeout seconds"""
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.changed.clear()
+
+    def take_pieces(self):
+        """Pieces verified since the last call"""
+        pieces, self.pieces = self.pieces, []
+        return pieces
+
+    def take_files(self):
+        """Files completed since the last call"""
+        files, self.files = self.files, []
+        return files
+
+class TorrentSession:
+    """The process-wide libtorrent session hosting every torrent job.
+    
+    One listen socket, one DHT node and one set of peer connections for all torrents.
+    The DHT routing table is saved to Config.TORRENT_STATE_FILE and loaded on startup,
+    so new jobs find peers without bootstrapping from scratch.
+    
+    Nothing polls the torrents: a dispatcher thread blocks in wait_for_alert, asks for
+    state_update_alerts once a second (only changed torrents are reported) and hands
+    each batch to the event loop, where it lands in the TorrentWatch of its torrent.
+    
+    Unfinished torrents survive restarts: their resume data is saved to resume_dir every
+    Config.TORRENT_RESUME_INTERVAL seconds and on close, next to a small owner record,
+    and removed with the torrent. saved_jobs() lists them on the next start.
+    
+    The metadata of every torrent is kept in metadata_dir as <info hash>.torrent, so a
+    magnet seen before starts with its files and size known instead of asking peers.
+    """
+
+    def __init__(self, state_file, resume_dir, metadata_dir):
+        self.state_file = state_file
+        self.resume_dir = resume_dir
+        self.metadata_dir = metadata_dir
+        self.session = None
+        self.watches = {}  # info hash -> TorrentWatch
+        self.owners = {}  # info hash -> owner record of torrents whose resume data is kept
+        self.lock = threading.Lock()
+        self.dispatcher = None
+        self.stopping = False
+        self.last_save = 0
+
+    def get(self):
+        """The shared session, started on first use"""
+        if self.session is None:
+            self.session = self._load()
+            self.session.apply_settings(SESSION_SETTINGS)
+            print("Torrent session started")
+        return self.session
+
+    def add(self, params, owner=None):
+        """Add a torrent from add_torrent_params - returns (handle, TorrentWatch).
+        
+        Call from the event loop; the watch gets this torrent's alerts from now on.
+        owner (JSON-safe dict) is stored with the resume data and returned by saved_jobs().
+        """
+        session = self.get()
+        if self.dispatcher is None:
+            self.stopping = False
+            self.dispatcher = threading.Thread(
+                target=self._dispatch, args=(session, asyncio.get_running_loop()), daemon=True
+            )
+            self.dispatcher.start()
+            
+        handle = session.add_torrent(params)
+        info_hash = str(handle.info_hash())
+        watch = TorrentWatch()
+        self.watches[info_hash] = watch
+        if owner is not None:
+            with self.lock:
+                self.owners[info_hash] = owner
+                self._write_file(self._resume_path(info_hash, '.json'), json.dumps(owner).encode())
+        return handle, watch
+
+    def remove(self, handle, delete_files=False):
+        """Take a torrent out of the session - with its data when delete_files"""
+        session = self.session
+        if session is None:
+            # Closed on shutdown - the torrent stays in the resume data
+            return
+        info_hash = str(handle.info_hash())
+        self.watches.pop(info_hash, None)
+        with self.lock:
+            # Finished or given up - nothing to resume on the next start
+            self.owners.pop(info_hash, None)
+            for ext in ('.fastresume', '.json'):
+                path = self._resume_path(info_hash, ext)
+                if os.path.exists(path):
+                    os.remove(path)
+                    
+        if delete_files:
+            session.remove_torrent(handle, lt.session.delete_files)
+        else:
+            session.remove_torrent(handle)
+            
+        # The routing table changes slowly - saving now and then is enough
+        if time.time() - self.last_save > 600:
+            self.save_state()
+
+    def resume_params(self, info_hash):
+        """add_torrent_params from the saved resume data of info_hash, or None"""
+        path = self._resume_path(info_hash, '.fastresume')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return lt.read_resume_data(f.read())
+        except Exception as e:
+            print(f"Resume data of {info_hash} ignored: {e}")
+            return None
+
+    def saved_jobs(self):
+        """Owner records of the torrents that were unfinished when the bot stopped"""
+        if not os.path.isdir(self.resume_dir):
+            return []
+        jobs = []
+        for name in os.listdir(self.resume_dir):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.resume_dir, name)) as f:
+                        jobs.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    print(f"Torrent job record {name} ignored: {e}")
+        return jobs
+
+    def cached_metadata(self, info_hash):
+        """torrent_info of info_hash from the metadata cache, or None"""
+        path = os.path.join(self.metadata_dir, info_hash + '.torrent')
+        if not os.path.exists(path):
+            return None
+        try:
+            info = lt.torrent_info(path)
+        except Exception as e:
+            print(f"Cached metadata of {info_hash} ignored: {e}")
+            return None
+        # Recently used entries survive pruning
+        os.utime(path)
+        return info
+        
+    def store_metadata(self, info):
+        """Add a torrent's metadata (torrent_info) to the cache - once per info hash.
+        
+        Blocking disk work - the downloader runs it in an executor.
+        """
+        path = os.path.join(self.metadata_dir, str(info.info_hash()) + '.torrent')
+        if os.path.exists(path):
+            return
+        try:
+            self._write_file(path, lt.bencode(lt.create_torrent(info).generate()))
+        except Exception as e:
+            print(f"Metadata of {info.info_hash()} not cached: {e}")
+            return
+            
+        # Drop the least recently used entries beyond the cache size
+        try:
+            names = [name for name in os.listdir(self.metadata_dir) if name.endswith('.torrent')]
+            if len(names) > Config.TORRENT_METADATA_CACHE_SIZE:
+                paths = sorted((os.path.join(self.metadata_dir, name) for name in names), key=os.path.getmtime)
+                for old in paths[:len(names) - Config.TORRENT_METADATA_CACHE_SIZE]:
+                    os.remove(old)
+        except OSError as e:
+            # Another job pruned at the same time - the next store tries again
+            print(f"Metadata cache pruning skipped: {e}")
+
+    def _resume_path(self, info_hash, ext):
+        return os.path.join(self.resume_dir, info_hash + ext)
+
+    def _write_file(self, path, data):
+        """Atomic write - a crash leaves the old file or the new one"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _request_resume(self, session, force=False):
+        """Ask torrents for resume data (only changed ones unless force) - returns how many will answer"""
+        count = 0
+        for handle in session.get_torrents():
+            if force or handle.need_save_resume_data():
+                handle.save_resume_data(RESUME_FLAGS)
+                count += 1
+        return count
+
+    def _write_resume(self, alert):
+        """Store the resume data of a save_resume_data_alert"""
+        info_hash = str(alert.handle.info_hash())
+        if hasattr(lt, 'write_resume_data_buf'):
+            data = lt.write_resume_data_buf(alert.params)
+        else:
+            data = lt.bencode(alert.resume_data)
+        with self.lock:
+            # A torrent removed meanwhile must not come back on the next start
+            if info_hash in self.owners:
+                self._write_file(self._resume_path(info_hash, '.fastresume'), data)
+
+    def _dispatch(self, session, loop):
+        """Dispatcher thread: turn alerts into (info hash, kind, value) events for the loop"""
+        last_post = 0
+        last_resume = time.monotonic()
+        while not self.stopping:
+            now = time.monotonic()
+            if now - last_post >= 1:
+                session.post_torrent_updates()
+                last_post = now
+            if now - last_resume >= Config.TORRENT_RESUME_INTERVAL:
+                self._request_resume(session)
+                last_resume = now
+            if session.wait_for_alert(500) is None:
+                continue
+                
+            # Alerts die with the next pop_alerts() - only plain values leave this thread
+            events = []
+            for alert in session.pop_alerts():
+                if isinstance(alert, lt.state_update_alert):
+                    events.extend((str(status.handle.info_hash()), 'status', status) for status in alert.status)
+                elif isinstance(alert, lt.piece_finished_alert):
+                    events.append((str(alert.handle.info_hash()), 'piece', alert.piece_index))
+                elif isinstance(alert, lt.file_completed_alert):
+                    events.append((str(alert.handle.info_hash()), 'file', alert.index))
+                elif isinstance(alert, lt.torrent_finished_alert):
+                    events.append((str(alert.handle.info_hash()), 'finished', True))
+                elif isinstance(alert, lt.metadata_failed_alert):
+                    events.append((str(alert.handle.info_hash()), 'error', METADATA_FAILED))
+                elif isinstance(alert, (lt.torrent_error_alert, lt.file_error_alert)):
+                    events.append((str(alert.handle.info_hash()), 'error', f"Torrent error: {alert.message()}"))
+                elif isinstance(alert, lt.save_resume_data_alert):
+                    self._write_resume(alert)
+            if events:
+                loop.call_soon_threadsafe(self._deliver, events)
+
+    def _deliver(self, events):
+        """Apply a batch of dispatcher events to the watches - runs on the event loop"""
+        for info_hash, kind, value in events:
+            watch = self.watches.get(info_hash)
+            if watch is None:
+                continue
+            if kind == 'status':
+                watch.status = value
+                watch.finished = watch.finished or value.is_finished
+            elif kind == 'piece':
+                watch.pieces.append(value)
+            elif kind == 'file':
+                watch.files.append(value)
+            elif kind == 'finished':
+                watch.finished = True
+            elif kind == 'error':
+                watch.error = watch.error or value
+            watch.changed.set()
+
+    def save_state(self):
+        """Write the DHT state to disk"""
+        if self.session is None:
+            return
+        self.last_save = time.time()
+        try:
+            if hasattr(lt, 'write_session_params_buf'):
+                # libtorrent 2.0
+                flags = lt.save_state_flags_t.save_dht_state
+                data = lt.write_session_params_buf(self.session.session_state(flags), flags)
+            else:
+                data = lt.bencode(self.session.save_state(lt.save_state_flags_t.save_dht_state))
+                
+            self._write_file(self.state_file, data)
+        except Exception as e:
+            print(f"Torrent session state not saved: {e}")
+
+    def close(self):
+        """Save resume data and DHT state, then stop the session - call once on shutdown.
+        
+        Blocks for up to about 12 seconds - call it from an executor.
+        """
+        if self.session is None:
+            return
+        self.stopping = True
+        if self.dispatcher:
+            self.dispatcher.join(timeout=2)
+            self.dispatcher = None
+        self.session.pause()
+        
+        # Final resume data of every unfinished torrent - the dispatcher is gone, collect it here
+        pending = self._request_resume(self.session, force=True)
+        deadline = time.monotonic() + 10
+        while pending > 0 and time.monotonic() < deadline:
+            if self.session.wait_for_alert(500) is None:
+                continue
+            for alert in self.session.pop_alerts():
+                if isinstance(alert, lt.save_resume_data_alert):
+                    self._write_resume(alert)
+                    pending -= 1
+                elif isinstance(alert, lt.save_resume_data_failed_alert):
+                    pending -= 1
+                    
+        self.save_state()
+        self.watches.clear()
+        self.session = None
+
+    def _load(self):
+        """New session, with the saved DHT state when there is one"""
+        data = None
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'rb') as f:
+                data = f.read()
+                
+        try:
+            if data and hasattr(lt, 'read_session_params'):
+                # libtorrent 2.0
+                return lt.session(lt.read_session_params(data, lt.save_state_flags_t.save_dht_state))
+            session = lt.session()
+            if data:
+                session.load_state(lt.bdecode(data))
+            return session
+        except Exception as e:
+            print(f"Torrent session state ignored: {e}")
+            return lt.session()
+
+torrent_session = TorrentSession(Config.TORRENT_STATE_FILE, Config.TORRENT_RESUME_DIR, Config.TORRENT_METADATA_DIR)
@@ -0,0 +1,488 @@
+import os
+import math
+import time
+import asyncio
+from pyrogram import raw, types, utils, StopTransmission
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from config import Config
+from helpers import get_mime_type, is_video_file, get_video_metadata, get_file_extension, humanbytes
+
+# Telegram accepts at most 512 KB per file part; files above 10 MB must use SaveBigFilePart
+PART_SIZE = 512 * 1024
+SMALL_FILE_MAX = 10 * 1024 * 1024
+
+# Albums hold at most 10 items; bigger images can only go out as documents
+MEDIA_GROUP_SIZE = 10
+PHOTO_MAX_SIZE = 10 * 1024 * 1024
+PHOTO_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp'}
+
+def read_part(filepath, offset, size):
+    """Read one part from disk - runs in a worker thread"""
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+async def parse_sent_message(client, result):
+    """Turn the raw SendMedia result into a pyrogram Message"""
+    users = {user.id: user for user in result.users}
+    chats = {chat.id: chat for chat in result.chats}
+    for update in result.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(client, update.message, users, chats)
+    return None
+
+async def video_metadata(filepath):
+    """(duration, width, height) from ffprobe - in a worker thread, the call blocks for seconds"""
+    return await asyncio.get_running_loop().run_in_executor(None, get_video_metadata, filepath)
+
+class MediaSessions:
+    """Extra MTProto media sessions to the bot's DC, shared by every upload.
+    
+    pyrogram sends all parts of a file through one session, so a single upload is held
+    to that session's window. Parts sent with invoke() are spread round-robin over up to
+    `size` sessions, which are opened on first use.
+    """
+    
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.sessions = []
+        self.next = 0
+        self.lock = None
+        
+    async def invoke(self, client, query):
+        session = await self._session(client)
+        return await session.invoke(query)
+        
+    async def _session(self, client):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+            
+        async with self.lock:
+            if len(self.sessions) < self.size:
+                session = Session(
+                    client, await client.storage.dc_id(), await client.storage.auth_key(),
+                    await client.storage.test_mode(), is_media=True
+                )
+                await session.start()
+                self.sessions.append(session)
+                return session
+                
+        self.next = (self.next + 1) % len(self.sessions)
+        return self.sessions[self.next]
+        
+    async def close(self):
+        """Stop every session - call once on shutdown"""
+        for session in self.sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                print(f"Media session stop failed: {e}")
+        self.sessions.clear()
+        
+async def save_part(client, file_id, part, total_parts, data, big=True, retries=5):
+    """Send one file part over the media sessions, waiting out flood limits and retrying transient errors"""
+    if big:
+        query = raw.functions.upload.SaveBigFilePart(
+            file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=data
+        )
+    else:
+        query = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part, bytes=data)
+        
+    attempt = 0
+    while True:
+        try:
+            await media_sessions.invoke(client, query)
+            return
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+        except Exception as e:
+            attempt += 1
+            if attempt >= retries:
+                raise
+            print(f"Part {part} upload failed, retrying: {e}")
+            await asyncio.sleep(2 ** attempt)
+            
+async def upload_parts(client, filepath, progress_callback=None, workers=None):
+    """Upload a finished file with Config.UPLOAD_WORKERS parts in flight - returns its InputFile.
+    
+    progress_callback(current, total, "Uploading", speed=...) follows pyrogram's progress
+    signature with this upload's throughput (bytes/s) added as a keyword; it may raise
+    StopTransmission (client.stop_transmission()) to abort.
+    """
+    loop = asyncio.get_running_loop()
+    size = os.path.getsize(filepath)
+    total_parts = max(1, math.ceil(size / PART_SIZE))
+    big = size > SMALL_FILE_MAX
+    file_id = client.rnd_id()
+    parts = iter(range(total_parts))  # Shared by the workers - each part is taken once
+    start = time.monotonic()
+    uploaded = 0
+    
+    async def worker():
+        nonlocal uploaded
+        for part in parts:
+            offset = part * PART_SIZE
+            data = await loop.run_in_executor(None, read_part, filepath, offset, min(PART_SIZE, size - offset))
+            await save_part(client, file_id, part, total_parts, data, big)
+            uploaded += len(data)
+            if progress_callback:
+                elapsed = time.monotonic() - start
+                await progress_callback(uploaded, size, "Uploading", speed=uploaded / elapsed if elapsed > 0 else None)
+                
+    tasks = [asyncio.create_task(worker()) for _ in range(min(workers or Config.UPLOAD_WORKERS, total_parts))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+            
+    elapsed = max(time.monotonic() - start, 0.001)
+    print(
+        f"Uploaded {os.path.basename(filepath)}: {humanbytes(size)} in {elapsed:.1f}s "
+        f"({size / elapsed / 1024 / 1024:.1f} MB/s, {len(tasks)} parts in flight)"
+    )
+    
+    name = os.path.basename(filepath)
+    if big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=name, md5_checksum="")
+    
+async def send_file(client, chat_id, filepath, upload_type, caption, thumbnail=None, progress=None):
+    """Upload a file with upload_parts() and send it as a video or a document - returns the sent message.
+    
+    upload_type 'doc' always sends a document. Like pyrogram's send_* methods, returns
+    None when progress stopped the transfer with client.stop_transmission().
+    """
+    filename = os.path.basename(filepath)
+    try:
+        file = await upload_parts(client, filepath, progress)
+    except StopTransmission:
+        return None
+        
+    attributes = [raw.types.DocumentAttributeFilename(file_name=filename)]
+    video = upload_type != 'doc' and is_video_file(filename)
+    if video:
+        duration, width, height = await video_metadata(filepath)
+        attributes.append(raw.types.DocumentAttributeVideo(
+            supports_streaming=True, duration=duration, w=width, h=height
+        ))
+        
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=get_mime_type(filename),
+        file=file,
+        thumb=await client.save_file(thumbnail) if thumbnail else None,
+        attributes=attributes,
+        force_file=upload_type == 'doc' or None
+    )
+    result = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(chat_id),
+            media=media,
+            random_id=client.rnd_id(),
+            **await utils.parse_text_entities(client, caption, None, None)
+        )
+    )
+    return await parse_sent_message(client, result)
+
+def list_files(dirpath):
+    """Every non-empty file under dirpath, in path order"""
+    files = []
+    for root, dirs, names in os.walk(dirpath):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.getsize(path) > 0:
+                files.append(path)
+    return files
+
+class StreamingUpload:
+    """Upload a file to Telegram part by part while it is still being downloaded.
+    
+    The downloader calls begin() once the target path and size are known and written()
+    for every byte range that reached the disk. Complete parts go out with SaveBigFilePart
+    straight away and in any order, so the upload ends shortly after the download does.
+    """
+
+    def __init__(self, client, chat_id, thumbnail=None, progress_callback=None):
+        self.client = client
+        self.chat_id = chat_id
+        self.thumbnail = thumbnail
+        self.progress_callback = progress_callback
+        
+        self.started = False
+        self.filepath = None
+        self.total_size = 0
+        self.total_parts = 0
+        self.part_bytes = []
+        self.queued = set()
+        self.parts_done = 0
+        self.uploaded = 0
+        self.ready = asyncio.Queue()
+        self.file_id = None
+        self.task = None
+
+    def begin(self, filepath, total_size):
+        """Start streaming filepath - returns False when the file is too small to bother"""
+        if self.started or total_size < Config.STREAM_MIN_SIZE:
+            return False
+            
+        self.filepath = filepath
+        self.total_size = total_size
+        self.total_parts = math.ceil(total_size / PART_SIZE)
+        self.part_bytes = [0] * self.total_parts
+        self.file_id = self.client.rnd_id()
+        self.started = True
+        self.task = asyncio.create_task(self._upload_parts())
+        return True
+
+    def written(self, offset, length):
+        """Account a byte range that reached the disk and queue every part it completed"""
+        if not self.started:
+            return
+            
+        end = offset + length
+        part = offset // PART_SIZE
+        while offset < end and part < self.total_parts:
+            part_end = min((part + 1) * PART_SIZE, self.total_size)
+            count = min(end, part_end) - offset
+            self.part_bytes[part] += count
+            if self.part_bytes[part] >= part_end - part * PART_SIZE and part not in self.queued:
+                self.queued.add(part)
+                self.ready.put_nowait(part)
+            offset += count
+            part += 1
+
+    async def finish(self, caption):
+        """Wait for the remaining parts and send the file - call after the download completed"""
+        await self.task
+        
+        filename = os.path.basename(self.filepath)
+        attributes = [raw.types.DocumentAttributeFilename(file_name=filename)]
+        if is_video_file(filename):
+            # The file is complete on disk now, so ffprobe can read it
+            duration, width, height = await video_metadata(self.filepath)
+            attributes.append(raw.types.DocumentAttributeVideo(
+                supports_streaming=True, duration=duration, w=width, h=height
+            ))
+            
+        thumb = await self.client.save_file(self.thumbnail) if self.thumbnail else None
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=get_mime_type(filename),
+            file=raw.types.InputFileBig(id=self.file_id, parts=self.total_parts, name=filename),
+            thumb=thumb,
+            attributes=attributes
+        )
+        
+        result = await self.client.invoke(
+            raw.functions.messages.SendMedia(
+                peer=await self.client.resolve_peer(self.chat_id),
+                media=media,
+                random_id=self.client.rnd_id(),
+                **await utils.parse_text_entities(self.client, caption, None, None)
+            )
+        )
+        return await parse_sent_message(self.client, result)
+
+    def abort(self):
+        """Stop uploading - the download failed or was cancelled"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    async def _upload_parts(self):
+        """Run the part workers until every part is on Telegram's side"""
+        workers = [asyncio.create_task(self._worker()) for _ in range(Config.UPLOAD_WORKERS)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            part = await self.ready.get()
+            if part is None:
+                return
+                
+            offset = part * PART_SIZE
+            size = min(PART_SIZE, self.total_size - offset)
+            data = await loop.run_in_executor(None, read_part, self.filepath, offset, size)
+            await self._save_part(part, data)
+            
+            self.parts_done += 1
+            self.uploaded += len(data)
+            if self.progress_callback:
+                await self.progress_callback(self.uploaded, self.total_size, "Uploading (streamed)")
+                
+            # Last part sent - release every worker
+            if self.parts_done == self.total_parts:
+                for _ in range(Config.UPLOAD_WORKERS):
+                    self.ready.put_nowait(None)
+
+    async def _save_part(self, part, data):
+        await save_part(self.client, self.file_id, part, self.total_parts, data)
+
+class FolderUpload:
+    """Upload every file of a directory (a multi-file torrent) to Telegram.
+    
+    Up to `concurrency` files are uploaded at once. Each finished file is registered with
+    UploadMedia, and the files go out as albums of up to MEDIA_GROUP_SIZE items in
+    directory order: videos and photos together and everything else as documents. With
+    upload_type 'doc', every file is a document. caption(path) gives each file's caption.
+    progress_callback reports the bytes of all files together.
+    """
+
+    def __init__(self, client, chat_id, dirpath, upload_type='original', thumbnail=None,
+                 caption=None, progress_callback=None, concurrency=3):
+        self.client = client
+        self.chat_id = chat_id
+        self.upload_type = upload_type
+        self.thumbnail = thumbnail
+        self.caption = caption
+        self.progress_callback = progress_callback
+        self.concurrency = max(1, concurrency)
+        
+        self.files = list_files(dirpath)
+        self.total_size = sum(os.path.getsize(path) for path in self.files)
+        self.uploaded = {}  # path -> bytes sent so far
+        self.sent = 0
+        self.failed = []  # (path, error)
+        self.task = None
+
+    async def run(self):
+        """Upload and send every file - returns (files sent, [(path, error)] of the failed ones)"""
+        self.task = asyncio.create_task(self._run())
+        await self.task
+        return self.sent, self.failed
+
+    def abort(self):
+        """Stop all uploads - run() raises CancelledError"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def kind(self, path):
+        """'video', 'photo' or 'document' - how the file is sent"""
+        if self.upload_type == 'original':
+            if is_video_file(path):
+                return 'video'
+            if get_file_extension(path) in PHOTO_EXTENSIONS and os.path.getsize(path) <= PHOTO_MAX_SIZE:
+                return 'photo'
+        return 'document'
+
+    def groups(self):
+        """Files split into albums - documents never share one with videos and photos"""
+        by_kind = {}
+        for path in self.files:
+            by_kind.setdefault('document' if self.kind(path) == 'document' else 'media', []).append(path)
+        return [
+            paths[i:i + MEDIA_GROUP_SIZE]
+            for paths in by_kind.values()
+            for i in range(0, len(paths), MEDIA_GROUP_SIZE)
+        ]
+
+    async def _run(self):
+        peer = await self.client.resolve_peer(self.chat_id)
+        slots = asyncio.Semaphore(self.concurrency)
+        groups = self.groups()
+        
+        # Files upload ahead on the pool; each album goes out once all of its files are up
+        prepared = [[asyncio.create_task(self._prepare(path, peer, slots)) for path in group] for group in groups]
+        try:
+            for group, tasks in zip(groups, prepared):
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                items = []
+                for path, result in zip(group, results):
+                    if isinstance(result, BaseException):
+                        self.failed.append((path, str(result)))
+                    else:
+                        items.append((path, result))
+                if not items:
+                    continue
+                    
+                try:
+                    await self._send(peer, [item for _, item in items])
+                    self.sent += len(items)
+                except Exception as e:
+                    self.failed.extend((path, str(e)) for path, _ in items)
+        finally:
+            for tasks in prepared:
+                for task in tasks:
+                    task.cancel()
+
+    async def _prepare(self, path, peer, slots):
+        """Upload one file and register it with UploadMedia - returns its InputSingleMedia"""
+        async def progress(current, total, *args, **kwargs):
+            await self._progress(current, total, path)
+            
+        async with slots:
+            kind = self.kind(path)
+            file = await upload_parts(self.client, path, progress)
+            
+            filename = os.path.basename(path)
+            if kind == 'photo':
+                media = raw.types.InputMediaUploadedPhoto(file=file)
+            else:
+                attributes = [raw.types.DocumentAttributeFilename(file_name=filename)]
+                if kind == 'video':
+                    duration, width, height = await video_metadata(path)
+                    attributes.append(raw.types.DocumentAttributeVideo(
+                        supports_streaming=True, duration=duration, w=width, h=height
+                    ))
+                media = raw.types.InputMediaUploadedDocument(
+                    mime_type=get_mime_type(filename),
+                    file=file,
+                    thumb=await self.client.save_file(self.thumbnail) if self.thumbnail else None,
+                    attributes=attributes,
+                    force_file=kind == 'document' or None
+                )
+                
+            uploaded = await self._invoke(raw.functions.messages.UploadMedia(peer=peer, media=media))
+            
+        if isinstance(uploaded, raw.types.MessageMediaPhoto):
+            media = raw.types.InputMediaPhoto(id=raw.types.InputPhoto(
+                id=uploaded.photo.id,
+                access_hash=uploaded.photo.access_hash,
+                file_reference=uploaded.photo.file_reference
+            ))
+        else:
+            media = raw.types.InputMediaDocument(id=raw.types.InputDocument(
+                id=uploaded.document.id,
+                access_hash=uploaded.document.access_hash,
+                file_reference=uploaded.document.file_reference
+            ))
+        caption = self.caption(path) if self.caption else ""
+        return raw.types.InputSingleMedia(
+            media=media,
+            random_id=self.client.rnd_id(),
+            **await utils.parse_text_entities(self.client, caption, None, None)
+        )
+
+    async def _send(self, peer, items):
+        """Send prepared files - one message, or one album"""
+        if len(items) == 1:
+            item = items[0]
+            await self._invoke(raw.functions.messages.SendMedia(
+                peer=peer, media=item.media, random_id=item.random_id,
+                message=item.message, entities=item.entities
+            ))
+        else:
+            await self._invoke(raw.functions.messages.SendMultiMedia(peer=peer, multi_media=items))
+
+    async def _invoke(self, query):
+        while True:
+            try:
+                return await self.client.invoke(query)
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+
+    async def _progress(self, current, total, path):
+        self.uploaded[path] = current
+        if self.progress_callback:
+            done = self.sent + len(self.failed)
+            await self.progress_callback(
+                sum(self.uploaded.values()), self.total_size,
+                f"Uploading {len(self.files)} files ({done} sent)"
+            )
+
+media_sessions = MediaSessions(Config.UPLOAD_SESSIONS)
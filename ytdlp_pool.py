@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import signal
+import time
+import asyncio
+import threading
+import yt_dlp
+from config import Config
+
+# Progress hook fields forwarded to the bot (the rest of the hook dict isn't JSON-safe)
+PROGRESS_FIELDS = (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'speed', 'eta', 'elapsed', 'filename', 'tmpfilename', 'fragment_index', 'fragment_count'
+)
+
+# A worker reports a download (and waits for its pacing delay) at most this often;
+# the bot charges the bytes by downloaded_bytes, so skipped hooks lose nothing
+PROGRESS_INTERVAL = 0.5  # seconds
+PROGRESS_BYTES = 1024 * 1024
+
+class WorkerError(Exception):
+    """A yt-dlp worker died, stalled or failed outside of yt-dlp itself"""
+
+class YtdlpWorker:
+    """One long-lived `python ytdlp_pool.py` process talking JSON lines over stdin/stdout"""
+
+    def __init__(self, process):
+        self.process = process
+        self.jobs = 0
+        self.killed = False
+
+    @property
+    def alive(self):
+        return not self.killed and self.process.returncode is None
+
+    async def send(self, message):
+        self.process.stdin.write((json.dumps(message) + '\n').encode())
+        await self.process.stdin.drain()
+
+    async def receive(self, timeout):
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        if not line:
+            raise WorkerError("yt-dlp worker exited unexpectedly")
+        return json.loads(line)
+
+    def kill(self):
+        if self.alive:
+            self.killed = True
+            self.kill_group()
+            # Reap it in the background
+            asyncio.ensure_future(self.process.wait())
+
+    def kill_group(self):
+        """Kill the worker with every process it started (ffmpeg merges and postprocessors)"""
+        try:
+            # Workers lead their own process group (start_new_session)
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, AttributeError):
+            if self.process.returncode is None:
+                self.process.kill()
+
+class YtdlpPool:
+    """Warm yt-dlp worker processes shared by every job.
+    
+    Each worker imports yt_dlp once and keeps its YoutubeDL instances between jobs, and
+    extraction runs in parallel across processes instead of fighting over one GIL.
+    Workers are started on demand up to size, recycled after max_jobs jobs, and killed
+    together with their child processes when a job sends nothing for stall_timeout
+    seconds or is cancelled.
+    """
+
+    def __init__(self, size, max_jobs=50, stall_timeout=600):
+        self.size = max(1, size)
+        self.max_jobs = max_jobs
+        self.stall_timeout = stall_timeout
+        self.idle = []
+        self.busy = set()
+        self.slots = None
+        self.stats = {'started': 0, 'recycled': 0, 'killed': 0, 'jobs': 0}
+
+    async def run(self, url, options, on_progress=None, info=None):
+        """Download url with the given YoutubeDL options in a worker.
+        
+        on_progress(data) is called on the event loop for every progress hook of the worker
+        (phase 'download') and returns how many seconds the worker should pause (bandwidth
+        pacing); postprocessor hooks arrive with phase 'postprocess' and need no answer. An info dict from
+        extract() is downloaded as-is instead of extracting the page again. Returns
+        (filename, title); raises yt_dlp.utils.DownloadError or WorkerError.
+        """
+        result = await self._submit({'action': 'download', 'url': url, 'options': options, 'info': info}, on_progress)
+        return result['filename'], result['title']
+
+    async def extract(self, url, options):
+        """Metadata-only extraction - returns the sanitized info dict"""
+        result = await self._submit({'action': 'extract', 'url': url, 'options': options})
+        return result['info']
+
+    async def _submit(self, job, on_progress=None):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size)
+            
+        async with self.slots:
+            worker = await self._acquire()
+            try:
+                return await self._run_on(worker, job, on_progress)
+            except (WorkerError, asyncio.TimeoutError, asyncio.CancelledError):
+                # The job may still be running inside the process - it can't be reused
+                self.stats['killed'] += 1
+                worker.kill()
+                raise
+            finally:
+                self._release(worker)
+
+    async def _run_on(self, worker, job, on_progress):
+        worker.jobs += 1
+        self.stats['jobs'] += 1
+        await worker.send(job)
+        
+        while True:
+            try:
+                message = await worker.receive(self.stall_timeout)
+            except asyncio.TimeoutError:
+                raise WorkerError(f"yt-dlp worker stalled for {self.stall_timeout}s")
+                
+            if message['type'] == 'progress':
+                delay = on_progress(dict(message['data'], phase='download')) if on_progress else 0
+                await worker.send({'delay': delay or 0})
+            elif message['type'] == 'postprocess':
+                if on_progress:
+                    on_progress(dict(message['data'], phase='postprocess'))
+            elif message['type'] == 'done':
+                return message
+            elif message['kind'] == 'download':
+                raise yt_dlp.utils.DownloadError(message['message'])
+            else:
+                raise WorkerError(message['message'])
+
+    async def _acquire(self):
+        while self.idle:
+            worker = self.idle.pop()
+            if worker.alive:
+                self.busy.add(worker)
+                return worker
+                
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=64 * 1024 * 1024,  # Info dicts of long videos run into megabytes
+            start_new_session=True  # Own process group - a kill takes ffmpeg children along
+        )
+        self.stats['started'] += 1
+        worker = YtdlpWorker(process)
+        self.busy.add(worker)
+        return worker
+
+    def _release(self, worker):
+        self.busy.discard(worker)
+        if not worker.alive:
+            return
+        if worker.jobs >= self.max_jobs:
+            # Recycle - drops whatever memory the extractors accumulated
+            self.stats['recycled'] += 1
+            worker.process.stdin.close()
+            return
+        self.idle.append(worker)
+
+    def get_stats(self):
+        return dict(self.stats, size=self.size, idle=len(self.idle), busy=len(self.busy))
+
+    async def close(self):
+        """Stop every worker - call once on shutdown"""
+        for worker in self.idle + list(self.busy):
+            if worker.process.returncode is None:
+                worker.kill_group()
+                await worker.process.wait()
+        self.idle.clear()
+        self.busy.clear()
+
+def worker_main():
+    """Worker process: run jobs from stdin until it is closed"""
+    # Keep stdout for the protocol; anything yt-dlp prints goes to stderr
+    ipc = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    
+    instances = {}  # options -> warm YoutubeDL
+    # Fragment downloads call the hooks from several threads - one request/reply at a time
+    lock = threading.Lock()
+    reported = {'time': 0, 'bytes': {}}  # last report, and downloaded_bytes reported per file
+
+    def send(message):
+        ipc.write(json.dumps(message) + '\n')
+        ipc.flush()
+
+    def progress_hook(d):
+        name = d.get('tmpfilename') or d.get('filename')
+        current = d.get('downloaded_bytes') or 0
+        with lock:
+            # Status changes and new files always go out; running downloads are batched
+            now = time.monotonic()
+            if (d.get('status') == 'downloading' and name in reported['bytes']
+                    and now - reported['time'] < PROGRESS_INTERVAL
+                    and current - reported['bytes'][name] < PROGRESS_BYTES):
+                return
+            reported['time'] = now
+            reported['bytes'][name] = current
+            
+            send({'type': 'progress', 'data': {key: d.get(key) for key in PROGRESS_FIELDS}})
+            reply = sys.stdin.readline()
+        if not reply:
+            sys.exit(0)
+        delay = json.loads(reply).get('delay', 0)
+        if delay > 0.001:
+            time.sleep(delay)
+
+    def postprocessor_hook(d):
+        with lock:
+            send({'type': 'postprocess', 'data': {'status': d.get('status'), 'postprocessor': d.get('postprocessor')}})
+        
+    for line in sys.stdin:
+        job = json.loads(line)
+        reported['bytes'].clear()
+        key = json.dumps(job['options'], sort_keys=True)
+        ydl = instances.pop(key, None)
+        if ydl is None:
+            if len(instances) >= 8:
+                instances.pop(next(iter(instances))).close()
+            ydl = yt_dlp.YoutubeDL(dict(
+                job['options'], progress_hooks=[progress_hook], postprocessor_hooks=[postprocessor_hook]
+            ))
+        instances[key] = ydl  # Most recently used last
+        
+        try:
+            if job['action'] == 'extract':
+                info = ydl.extract_info(job['url'], download=False)
+                send({'type': 'done', 'info': ydl.sanitize_info(info)})
+                continue
+                
+            if job.get('info'):
+                # Same path as --load-info-json: select formats and download, no page request
+                info = ydl.process_ie_result(job['info'], download=True)
+            else:
+                info = ydl.extract_info(job['url'], download=True)
+            send({'type': 'done', 'filename': ydl.prepare_filename(info), 'title': info.get('title', 'Video')})
+        except yt_dlp.utils.DownloadError as e:
+            send({'type': 'error', 'kind': 'download', 'message': str(e)})
+        except Exception as e:
+            send({'type': 'error', 'kind': 'other', 'message': str(e)})
+
+if __name__ == '__main__':
+    worker_main()
+else:
+    ytdlp_pool = YtdlpPool(Config.YTDLP_WORKERS, Config.YTDLP_WORKER_MAX_JOBS, Config.YTDLP_STALL_TIMEOUT)